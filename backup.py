@@ -28,51 +28,345 @@ import getopt;
 import os;
 import shutil;
 import re;
+import stat;
+import json;
+import collections;
+import concurrent.futures;
+import multiprocessing;
+import time;
+import threading;
+import queue;
+import itertools;
+import hashlib;
+import gzip;
+import lzma;
+import bz2;
+import io;
+import errno;
+import zlib;
+import tempfile;
+import struct;
+import ctypes;
+import ctypes.util;
+import heapq;
+import contextlib;
+import array;
+try:
+	import fcntl;
+except ImportError:
+	fcntl = None; # Not on Windows, no reflinks.
+try:
+	import resource;
+except ImportError:
+	resource = None; # Not on Windows, no peak memory.
 from datetime import datetime;
 from abc import ABCMeta, abstractmethod;
 
 # Full backup: copy every file from the source to the destination.
 # Incremental backup: only copy files into new increment if they changed from any previous increment or the full backup.
+# Differential backup: only copy files into new differential if they changed from the full backup.
 
-BACKUP_USAGE = "Usage: backup.py [-f|-i] source+ destination"
+BACKUP_USAGE = """Usage: backup.py [-f|-i|-d] [-c] [-j jobs] [-p processes] [--dedup] [--link-dest] [--hash] [--delta-over size] [--compress gz|xz|bz2] [--pack-under size] [--buffer size] [--report file] [--resume]
+                 [--exclude pattern] [--include pattern] [--exclude-from file] source+ destination
+       backup.py -r|-l name [--version n[-m] | --at yyyy-mm-dd_hhmm] [-j jobs] destination [target]
+       backup.py --watch [--exclude pattern] [--include pattern] [--exclude-from file] source+ destination
+       backup.py --verify name [--version n[-m] | --at yyyy-mm-dd_hhmm] [-j jobs] [--source dir] [--rate size] [--resume] [--report file] destination
+       backup.py --synthesize-full name [--version n[-m] | --at yyyy-mm-dd_hhmm] [-j jobs] [--report file] destination"""
 
 TYPE_FULL = "Full"
 TYPE_INCREMENT = "Increment";
+TYPE_DIFFERENTIAL = "Differential";
+FULL_VERSION_REGEX = re.compile(r"^[0-9]{4}-[0-9]{2}-[0-9]{2}_[0-9]{4}__" + TYPE_FULL + r"-([0-9]{1,})$");
+INCREMENT_VERSION_REGEX = re.compile(r"^[0-9]{4}-[0-9]{2}-[0-9]{2}_[0-9]{4}__" + TYPE_INCREMENT + r"-([0-9]{1,})-([0-9]{1,})$");
+DIFFERENTIAL_VERSION_REGEX = re.compile(r"^[0-9]{4}-[0-9]{2}-[0-9]{2}_[0-9]{4}__" + TYPE_DIFFERENTIAL + r"-([0-9]{1,})-([0-9]{1,})$");
+
+# The versions of each backup name are listed in a catalog in its directory,
+# written when a version completes, so they are found without listing it.
+CATALOG_NAME = ".catalog";
+
+# What a backup keeps about a version besides the backed up files is kept in a
+# metadata directory beside it, named after it with this suffix, so no file of
+# a source can take the place of any of it. The version holds only the files.
+METADATA_SUFFIX = ".meta";
+
+# Every version records the files it holds in a manifest in its metadata.
+# Versions made before the metadata directory have it at their root.
+MANIFEST_NAME = "manifest";
+LEGACY_MANIFEST_NAME = ".manifest";
+MANIFEST_HEADER = "# backup manifest 1";
+
+# With deduplication the contents of files are kept once in an object store in
+# the destination and the manifests refer to them by checksum.
+OBJECT_STORE_NAME = ".objects";
+STORAGE_OBJECT = "o";
+
+# Large files changed in an increment can be stored as the blocks that changed
+# since their last copy: the blocks in the deltas directory of the metadata of
+# the version and the checksum of every block in the blocks directory, each
+# under the relative filepath of the file.
+STORAGE_DELTA = "d";
+DELTAS_DIR = "deltas";
+BLOCKS_DIR = "blocks";
+DELTA_BLOCK_SIZE = 1024 * 1024;
+
+# Copies can be compressed as they are written, by the copying threads. Files
+# that are already compressed are copied as they are.
+STORAGE_COMPRESSED = "z";
+COMPRESSORS = {
+	"gz": lambda filepath, mode: gzip.open(filepath, mode, compresslevel=6),
+	"xz": lambda filepath, mode: lzma.open(filepath, mode),
+	"bz2": lambda filepath, mode: bz2.open(filepath, mode)};
+COMPRESS_SKIP = {".gz", ".tgz", ".xz", ".txz", ".bz2", ".zip", ".7z", ".rar", ".zst", ".lz4",
+	".jar", ".apk", ".docx", ".xlsx", ".pptx", ".odt", ".ods", ".epub",
+	".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic",
+	".mp3", ".aac", ".ogg", ".flac", ".m4a", ".opus",
+	".mp4", ".m4v", ".mkv", ".avi", ".mov", ".webm"};
+
+# Small files can be appended to pack files in the packs directory of the
+# metadata of a version instead of each being copied to a file of its own.
+STORAGE_PACK = "p";
+PACKS_DIR = "packs";
+PACK_SIZE = 256 * 1024 * 1024;
+
+# The timings and counts of backing up a source are reported in the metadata
+# of the version.
+REPORT_NAME = "report";
+SLOWEST_FILES = 10;
+
+# Each file copied is recorded in the journal of the version as soon as it is
+# done, so an interrupted backup can be resumed. The journal is synced to disk
+# after this many files or seconds and removed once the manifest is written.
+JOURNAL_NAME = "journal";
+JOURNAL_SYNC_FILES = 256;
+JOURNAL_SYNC_SECONDS = 1.0;
+
+# Verifying a version reads in large blocks. Files verified so far are kept in
+# the directory of the backup name so an interrupted verify can be resumed.
+VERIFY_READ_SIZE = 4 * 1024 * 1024;
+VERIFY_STATE_PREFIX = ".verify-";
+
+# The watcher records the directories changed in each source in a change log in
+# the directory of the backup name, so increments only walk those directories.
+# A directory is logged again at most once a CHANGE_LOG_DEDUP seconds, and
+# increments take the changes from CHANGE_LOG_SLACK seconds before the start of
+# the last backup. A log larger than CHANGE_LOG_SIZE is started again.
+CHANGE_LOG_NAME = ".changes";
+CHANGE_LOG_DEDUP = 1.0;
+CHANGE_LOG_SLACK = 2.0;
+CHANGE_LOG_SIZE = 64 * 1024 * 1024;
+
+# Checksums of the source files, kept in the directory of each backup name.
+HASH_CACHE_NAME = ".hashcache";
+
+# How often the progress line is redrawn on a terminal, and written when the
+# output is not a terminal.
+PROGRESS_INTERVAL = 0.125;
+PROGRESS_LOG_INTERVAL = 10;
+
+# How far each stage of a backup can run ahead of the next: directories
+# walked ahead of deciding and files decided ahead of copying.
+WALK_QUEUE_SIZE = 64;
+COPY_QUEUE_SIZE = 1024;
+
+# The files to copy are held in memory up to this many bytes, then written out
+# to a temporary file.
+COPY_LIST_MEMORY = 64 * 1024 * 1024;
+COPY_BUFFER_SIZE = 1024 * 1024;
 
 class Interface(object):
 	"""Provides a command line interface for creating backups."""
 
+	# Set to false to silence progress, as in worker processes.
+	verbose = True;
+
 	def main(self):
 		mode = 0;
 		FULL = 1;
 		INC = 2;
+		RESTORE = 3;
+		LIST = 4;
+		VERIFY = 5;
+		WATCH = 6;
+		SYNTHESIZE = 7;
+		DIFF = 8;
+		MODES = "Must select one of -f/--full, -i/--increment, -d/--differential, -r/--restore, -l/--list, --verify, --watch or --synthesize-full.";
 
 		try:
 			if len(sys.argv[1:]) == 0:
-				terminate(BACKUP_USAGE);
-
-			options, args = getopt.getopt(sys.argv[1:], "fi", ["full", "increment"]);
+				Interface.terminate(BACKUP_USAGE);
+
+			checksums = False;
+			jobs = 1;
+			processes = 1;
+			dedup = False;
+			link_dest = False;
+			hash_changes = False;
+			delta_threshold = None;
+			compression = None;
+			pack_threshold = None;
+			buffer_size = COPY_BUFFER_SIZE;
+			report_path = None;
+			resume = False;
+			walk_filter = Filter();
+			source = None;
+			rate = None;
+			backup_name = None;
+			version = None;
+			at = None;
+			options, args = getopt.getopt(sys.argv[1:], "fidr:l:j:p:c",
+				["full", "increment", "differential", "restore=", "list=", "version=", "at=", "checksum", "jobs=", "parallel=",
+				"dedup", "link-dest", "hash", "delta-over=", "compress=", "pack-under=", "buffer=", "report=", "resume", "verify=", "source=", "rate=",
+				"exclude=", "include=", "exclude-from=", "watch", "synthesize-full="]);
 			# options full or inc backup, args sources and last arg destination
 			for o, v in options:
 				if o == "-f" or o == "--full":
 					if mode == 0:
 						mode = FULL;
 					else:
-						terminate("Must select either -f/--full or i/--increment.");
+						Interface.terminate(MODES);
 				if o == "-i" or o == "--increment":
 					if mode == 0:
 						mode = INC;
 					else:
-						terminate("Must select either -f/--full or i/--increment.");
+						Interface.terminate(MODES);
+				if o == "-d" or o == "--differential":
+					if mode == 0:
+						mode = DIFF;
+					else:
+						Interface.terminate(MODES);
+				if o == "--watch":
+					if mode == 0:
+						mode = WATCH;
+					else:
+						Interface.terminate(MODES);
+				if o in ("-r", "--restore", "-l", "--list", "--verify", "--synthesize-full"):
+					if mode == 0:
+						mode = {"-r": RESTORE, "--restore": RESTORE, "--verify": VERIFY,
+							"--synthesize-full": SYNTHESIZE}.get(o, LIST);
+						backup_name = v;
+					else:
+						Interface.terminate(MODES);
+				if o == "--version":
+					version = v;
+				if o == "--at":
+					at = v;
+				if o == "-c" or o == "--checksum":
+					checksums = True;
+				if o == "-j" or o == "--jobs":
+					jobs = Interface.positive_int(o, v);
+				if o == "-p" or o == "--parallel":
+					processes = Interface.positive_int(o, v);
+				if o == "--dedup":
+					dedup = True;
+				if o == "--link-dest":
+					link_dest = True;
+				if o == "--hash":
+					hash_changes = True;
+				if o == "--delta-over":
+					delta_threshold = Interface.size(o, v);
+				if o == "--compress":
+					if v not in COMPRESSORS:
+						Interface.terminate("--compress must be one of %s." % ", ".join(sorted(COMPRESSORS)), 1);
+					compression = v;
+				if o == "--pack-under":
+					pack_threshold = Interface.size(o, v);
+				if o == "--buffer":
+					buffer_size = Interface.size(o, v);
+				if o == "--report":
+					report_path = v;
+				if o == "--resume":
+					resume = True;
+				if o == "--source":
+					source = v;
+				if o == "--rate":
+					rate = Interface.size(o, v);
+				if o == "--exclude":
+					walk_filter.exclude(v);
+				if o == "--include":
+					walk_filter.include(v);
+				if o == "--exclude-from":
+					try:
+						walk_filter.read(v);
+					except OSError:
+						Interface.terminate("Cannot read %s" % v, 1);
+
+			# For restore the args are the destination holding the backups and the
+			# directory to restore to, for list just the destination.
+			if mode == RESTORE or mode == LIST:
+				if len(args) != (2 if mode == RESTORE else 1):
+					Interface.terminate(BACKUP_USAGE, 1);
+				restore = Restore(args[0], backup_name, jobs);
+				try:
+					chain = restore.find_chain(version, at);
+					if mode == LIST:
+						restore.show_list(chain);
+					else:
+						restore.restore(chain, args[1]);
+						restore.show_errors();
+				except NoVersionError as nv:
+					Interface.terminate("No backup version found: %s" % nv, 1);
+				return;
+
+			# For verify the arg is the destination holding the backups.
+			if mode == VERIFY:
+				if len(args) != 1:
+					Interface.terminate(BACKUP_USAGE, 1);
+				if source is not None and not os.path.isdir(source):
+					Interface.terminate("Source not found: %s" % source, 1);
+				verify = Verify(args[0], backup_name, jobs, source, rate);
+				try:
+					report = verify.verify(verify.find_chain(version, at), resume);
+				except NoVersionError as nv:
+					Interface.terminate("No backup version found: %s" % nv, 1);
+				verify.show_report(report);
+				if report_path is not None:
+					Backup.write_json(report_path, report);
+				if report["missing"] or report["corrupt"] or report["mismatched"]:
+					sys.exit(1);
+				return;
+
+			# For synthesize the arg is the destination holding the backups.
+			if mode == SYNTHESIZE:
+				if len(args) != 1:
+					Interface.terminate(BACKUP_USAGE, 1);
+				synthesize = Synthesize(args[0], backup_name, jobs);
+				try:
+					report = synthesize.synthesize(synthesize.find_chain(version, at));
+				except NoVersionError as nv:
+					Interface.terminate("No backup version found: %s" % nv, 1);
+				synthesize.show_errors();
+				if report_path is not None:
+					Backup.write_json(report_path, report);
+				if report["version"] is None:
+					sys.exit(1);
+				Interface.println("Synthesized %s: %d files, %d linked, %.1fs" % (report["version"],
+					report["files"], report["linked"], report["seconds"]));
+				return;
 
 			# For the modes full and increment the args will be a list of sources followed by the destination.
 			# Any trailing slashes will be removed.
-			if mode == FULL or mode == INC:
+			if mode == FULL or mode == INC or mode == DIFF or mode == WATCH:
 				backup = None;
-				if mode == FULL:
+				if mode == FULL or mode == WATCH:
 					backup = Full();
+					backup.link_dest = link_dest;
 				elif mode == INC:
 					backup = Increment();
+				elif mode == DIFF:
+					backup = Differential();
+				backup.checksums = checksums;
+				backup.jobs = jobs;
+				backup.processes = processes;
+				backup.dedup = dedup;
+				backup.hash_changes = hash_changes;
+				backup.delta_threshold = delta_threshold;
+				backup.compression = compression;
+				backup.pack_threshold = pack_threshold;
+				backup.buffer_size = buffer_size;
+				backup.report_path = report_path;
+				backup.resume = resume;
+				if walk_filter:
+					backup.filter = walk_filter;
 
 				for i, a in enumerate(args):
 					if i < len(args) - 1:
@@ -84,7 +378,20 @@ class Interface(object):
 
 			# Check the options and args provided by the user.
 			if not backup.has_sources() or not backup.has_destination():
-				terminate("No valid sources or destination.", 1);
+				Interface.terminate("No valid sources or destination.", 1);
+
+			if mode == WATCH:
+				try:
+					watcher = Watcher(backup.filter);
+					for s in backup.sources:
+						watcher.add_source(s, os.path.join(backup.destination, backup.get_backup_name(s)));
+				except OSError as e:
+					Interface.terminate("Cannot watch the sources: %s" % e, 1);
+				try:
+					watcher.run();
+				except KeyboardInterrupt:
+					pass;
+				return;
 
 			try:
 				backup.backup();
@@ -98,12 +405,32 @@ class Interface(object):
 				Interface.println("Something Happened\nBackup Terminated");
 
 		except getopt.GetoptError:
-			terminate("Invalid option found.\n%s" % BACKUP_USAGE);
+			Interface.terminate("Invalid option found.\n%s" % BACKUP_USAGE);
+
+	@staticmethod
+	def positive_int(option, value):
+		"""Parses the value of an option that must be a whole number above zero."""
+		try:
+			n = int(value);
+		except ValueError:
+			n = 0;
+		if n < 1:
+			Interface.terminate("%s must be a whole number above zero." % option, 1);
+		return n;
+
+	@staticmethod
+	def size(option, value):
+		"""Parses a number of bytes with an optional K, M or G suffix."""
+		units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3};
+		scale = units.get(value[-1:].upper(), 1);
+		if scale > 1:
+			value = value[:-1];
+		return Interface.positive_int(option, value) * scale;
 
 	@staticmethod
 	def println(line, end="\n"):
 		"""Controls printing to the terminal."""
-		if __name__ == "__main__": # and if verbose mode on. TODO
+		if __name__ == "__main__" and Interface.verbose:
 			print(line, end=end);
 
 	@staticmethod
@@ -128,11 +455,50 @@ class Backup(metaclass=ABCMeta):
 		A list of directory filepaths to backup.
 	destination : string
 		The directory filepath to save the backup to.
+	checksums : bool
+		Whether to record a checksum of each file in the manifest.
+	jobs : int
+		The number of files to copy at the same time.
+	processes : int
+		The number of sources to back up at the same time.
+	dedup : bool
+		Whether to keep file contents in the object store of the destination.
+	hash_changes : bool
+		Whether increments find changed files by their checksum rather than
+		their date modified. Checksums are kept in a hash cache.
+	delta_threshold : int or None
+		Files changed in an increment larger than this many bytes are stored
+		as the blocks that changed.
+	compression : str or None
+		The key in COMPRESSORS to compress the copies with.
+	pack_threshold : int or None
+		Files smaller than this many bytes are appended to pack files.
+	buffer_size : int
+		The size of the reads when copying through a buffer.
+	report_path : str or None
+		Where the JSON report of the run is written, if anywhere.
+	resume : bool
+		Whether to carry on with the last version if it was interrupted,
+		keeping the files its journal shows were copied.
+	filter : Filter or None
+		Which files and directories of the sources to leave out.
 	"""
 
 	def __init__(self):
 		self.sources = [];
 		self.destination = None;
+		self.checksums = False;
+		self.jobs = 1;
+		self.processes = 1;
+		self.dedup = False;
+		self.hash_changes = False;
+		self.delta_threshold = None;
+		self.compression = None;
+		self.pack_threshold = None;
+		self.buffer_size = COPY_BUFFER_SIZE;
+		self.report_path = None;
+		self.resume = False;
+		self.filter = None;
 
 		self.copy = None
 		self.current_source = -1;
@@ -140,6 +506,12 @@ class Backup(metaclass=ABCMeta):
 		self.backup_version = None;
 		self.backup_path = None;
 		self.last_full = None;
+		self.manifest = None;
+		self.shared_found = None;
+		self.hashes = None;
+		self.stats = None;
+		self.journal = None;
+		self.resumed = None;
 
 	def add_source(self, directory):
 		"""Adds a source to the source list for the backup.
@@ -173,26 +545,107 @@ class Backup(metaclass=ABCMeta):
 		return self.destination != None;
 
 	def backup(self):
-		"""This one does the backup."""
-		for i, src in enumerate(self.sources):
-			self.backup_source(i);
+		"""This one does the backup.
+		Returns : [dict]
+			The summary of each source, see backup_source."""
+		started = time.time();
+		if self.processes > 1 and len(self.sources) > 1:
+			summaries = self.backup_parallel();
+		else:
+			summaries = [self.backup_source(i) for i in range(len(self.sources))];
+		Backup.show_summaries(summaries);
+		peak = Stats.peak_memory();
+		if peak is not None:
+			Interface.println("Peak memory: %.1f MiB" % (peak / 1024));
+		if self.report_path is not None:
+			Backup.write_json(self.report_path, {"type": type(self).__name__,
+				"started": datetime.fromtimestamp(started).isoformat(), "seconds": time.time() - started,
+				"peak_memory_kb": peak, "sources": summaries});
+		return summaries;
+
+	def backup_parallel(self):
+		"""Backs up the sources at the same time in worker processes, at most
+		self.processes at once, showing the combined progress.
+		Returns : [dict]
+			The summary of each source in the order of the sources list."""
+		found = multiprocessing.RawArray("q", len(self.sources));
+		summaries = [None] * len(self.sources);
+		progress = Progress(lambda: "Sources complete: %d of %d / Found %d files" %
+			(sum(s is not None for s in summaries), len(self.sources), sum(found)));
+		with progress, concurrent.futures.ProcessPoolExecutor(self.processes,
+			initializer=_init_source_worker, initargs=(found,)) as executor:
+			futures = {executor.submit(_backup_source_worker, self, i): i for i in range(len(self.sources))};
+			for f in concurrent.futures.as_completed(futures):
+				summaries[futures[f]] = f.result();
+		return summaries;
+
+	@staticmethod
+	def show_summaries(summaries):
+		"""Prints the result of each source backed up."""
+		for s in summaries:
+			line = "%s: %s files, %s bytes copied, " % (s["name"], s["files"], s["bytes"]);
+			if s["linked"]:
+				line += "%s files, %s bytes linked, " % (s["linked"], s["linked_bytes"]);
+			line += "%s errors, %.1fs" % (len(s["errors"]), s["seconds"]);
+			if s["copy_methods"]:
+				line += " (%s)" % ", ".join("%s: %s bytes" % m for m in sorted(s["copy_methods"].items()));
+			if s["failure"]:
+				line += " - Failed: %s" % s["failure"];
+			Interface.println(line);
 
 	def backup_source(self, src_num):
 		"""Backs up a source in the sources list.
 		src_num : int
 			The index of the source from the sources list.
+		Returns : dict
+			A summary of the source with the keys name, version, found, files,
+			bytes, linked, linked_bytes, copy_methods, errors, started, seconds,
+			failure and stats, the timings and counts from Stats.report.
 		Raises
 			IndexError if src_num is not valid number.
 			NoFullBackupError if no last backup when required (increment only)"""
+		started = time.time();
+		self.stats = Stats();
 		self.backup_init(src_num);
-		for path, dirnames, filenames in os.walk(self.sources[src_num]):
-			relpath = path[len(self.sources[src_num]):]  # Remove the dir filepath leaving only a relative path to the file.
-			relpath = relpath.lstrip(os.sep);  # remove any leading path seperators
-			for fname in filenames:
-				self.backup_file(os.path.join(relpath, fname));
-		Interface.println(""); # print a new line char \n after backup_file called for all files
-		self.copy.start();
+		found = 0;
+		# The source is walked in a background thread and files are copied in
+		# another as they are found, with bounded queues between the stages.
+		# Progress is shown on a timer so finding and copying a file only adds
+		# to counters.
+		progress = Progress(self.progress_line);
+		self.journal.start();
+		self.copy.begin();
+		walk = self.stats.timed("walk", self.source_walk(src_num));
+		try:
+			for relpath, files in in_background(walk, WALK_QUEUE_SIZE):
+				with self.stats.phase("decide"):
+					for fname, st in files:
+						self.backup_file(os.path.join(relpath, fname), st);
+				found += len(files);
+				if self.shared_found is not None:
+					self.shared_found[src_num] = found;
+			with self.stats.phase("decide"):
+				self.files_done();
+		finally:
+			try:
+				with self.stats.phase("copy_wait"):
+					self.copy.finish();
+			finally:
+				progress.stop();
+		self.copy.show_count();
 		self.copy.show_errors();
+		with self.stats.phase("manifest"):
+			self.write_manifest();
+			Catalog.update(os.path.join(self.destination, self.backup_name));
+		summary = {"name": self.backup_name, "version": self.backup_version, "started": started, "found": found,
+			"files": len(self.manifest) - self.copy.linked,
+			"bytes": sum(e.size for rel, e in self.manifest.items()) - self.copy.linked_bytes,
+			"linked": self.copy.linked, "linked_bytes": self.copy.linked_bytes,
+			"copy_methods": dict(self.copy.kernel.bytes), "errors": self.copy.errors,
+			"seconds": time.time() - started, "failure": None, "stats": self.stats.report()};
+		if os.path.isdir(self.backup_path):
+			Backup.write_json(os.path.join(Backup.metadata_path(self.backup_path), REPORT_NAME), summary);
+		return summary;
 
 	def backup_init(self, src_num):
 		"""Sets up the source for backup.
@@ -209,15 +662,263 @@ class Backup(metaclass=ABCMeta):
 		Interface.println("Starting Backup %s of %s: %s" % (src_num + 1, len(self.sources), self.backup_name));
 		if self.destination == None:
 			raise NoDestinationError();
-		self.backup_version = self.new_backup_version(self.destination, self.backup_name);
+		if self.stats is None:
+			self.stats = Stats();
+		with self.stats.phase("discovery"):
+			self.backup_version = self.new_backup_version(self.destination, self.backup_name);
+			self.resumed = None;
+			if self.resume:
+				interrupted = self.interrupted_version(os.path.join(self.destination, self.backup_name));
+				if interrupted is not None:
+					self.backup_version = os.path.basename(interrupted);
+					self.resumed = Journal.read(interrupted);
+					Interface.println("Resuming %s: %d files already copied" % (self.backup_version, len(self.resumed)));
 		self.backup_path = os.path.join(self.destination, self.backup_name, self.backup_version);
-		self.copy = Copying();
+		self.journal = Journal(self.backup_path);
+		self.copy = Copying(self.jobs, ObjectStore(self.destination) if self.dedup else None,
+			self.checksums or self.hash_changes, self.compression);
+		self.copy.stats = self.stats;
+		self.copy.kernel.buffer_size = self.buffer_size;
+		self.copy.version_path = self.backup_path;
+		if self.pack_threshold is not None:
+			self.copy.packs = PackWriter(self.backup_path);
+			self.copy.pack_threshold = self.pack_threshold;
+		self.copy.on_stored = self.file_stored;
+		self.hashes = None;
+		if self.hash_changes:
+			self.hashes = HashCache(os.path.join(self.destination, self.backup_name));
+		self.manifest = FileIndex();
+
+	def source_walk(self, src_num):
+		"""Walks the source being backed up, see walk."""
+		return Backup.walk(self.sources[src_num], self.stats, self.filter);
+
+	@staticmethod
+	def walk(top, stats=None, walk_filter=None, start="", recursive=True):
+		"""Walks a source directory with os.scandir, keeping the stat of each
+		file so it never has to be stat'ed again. Like os.walk symbolic links to
+		directories are not followed and links to files are.
+		stats : Stats
+			Counts the directories listed and the files stat'ed, if given.
+		walk_filter : Filter
+			Leaves out the files it excludes and never enters the directories
+			it excludes, if given.
+		start : str
+			The directory to start from, relative to top.
+		recursive : bool
+			Whether to walk the directories below start or only list it.
+		Yields : (str, [(str, os.stat_result)])
+			For each directory its filepath relative to top and its files with
+			their stat, which is None if the file could not be stat'ed."""
+		stack = [start];
+		while stack:
+			relpath = stack.pop();
+			files = [];
+			try:
+				it = os.scandir(os.path.join(top, relpath));
+			except OSError:
+				continue;
+			with it:
+				for e in it:
+					try:
+						is_dir = e.is_dir();
+					except OSError:
+						is_dir = False;
+					if is_dir:
+						if recursive and not e.is_symlink() and (walk_filter is None
+							or walk_filter.wants_directory(os.path.join(relpath, e.name))):
+							stack.append(os.path.join(relpath, e.name));
+						continue;
+					if walk_filter is not None and not walk_filter.wants_file(os.path.join(relpath, e.name)):
+						continue;
+					try:
+						st = e.stat();
+					except OSError:
+						st = None;
+					files.append((e.name, st));
+			if stats is not None:
+				stats.add(listdir=1, stat=len(files));
+			yield (relpath, files);
 
 	@abstractmethod
-	def backup_file(self, rel_filepath):
+	def backup_file(self, rel_filepath, st=None):
 		"""How the different backups backup each file.
 		rel_filepath : str
-			The filepath relative to the source filepath."""
+			The filepath relative to the source filepath.
+		st : os.stat_result
+			The stat of the source file from walking the source, stat'ed
+			again if None."""
+
+	def files_done(self):
+		"""Called once every file of the source has been through backup_file."""
+
+	@abstractmethod
+	def progress_line(self):
+		"""The line showing the progress of the source being backed up."""
+
+	def stat_source(self, rel_filepath):
+		"""Stats a source file, reporting it as a copy error if it cannot be.
+		Returns : os.stat_result or None"""
+		src_filepath = os.path.join(self.sources[self.current_source], rel_filepath);
+		self.stats.add(stat=1);
+		try:
+			return os.stat(src_filepath);
+		except FileNotFoundError:
+			self.copy.add_error("Not Found", src_filepath);
+		except PermissionError:
+			self.copy.add_error("Permission Denied", src_filepath);
+		except OSError:
+			self.copy.add_error("Cannot Stat", src_filepath);
+		return None;
+
+	def queue_file(self, rel_filepath, st, checksum=None, entry=None):
+		"""Adds a file to be copied into the new version and records it in
+		the manifest. When checksums are wanted they are worked out while
+		copying.
+		rel_filepath : str
+			The filepath relative to the source filepath.
+		st : os.stat_result
+			The stat of the source file.
+		checksum : str
+			The checksum of the source file if already known.
+		entry : FileEntry
+			The last backed up copy of the file, if any. Large files are
+			stored as a delta against it."""
+		if self.resumed is not None and self.copied_before(rel_filepath, st):
+			return;
+		src_filepath = os.path.join(self.sources[self.current_source], rel_filepath);
+		base = None;
+		# Any stored copy can be a base, copy_out reads each kind of storage.
+		if entry is not None and self.delta_threshold is not None and st.st_size > self.delta_threshold:
+			base = (self.destination, rel_filepath, entry);
+		# In the manifest before it is queued, so it is there when the copy is done.
+		self.manifest.add(rel_filepath, FileEntry.from_stat(st, checksum));
+		self.copy.add(src_filepath, os.path.join(self.backup_path, os.path.dirname(rel_filepath)), st, base);
+
+	def copied_before(self, rel_filepath, st):
+		"""When resuming, whether the file was copied by the interrupted run and
+		has not changed since. Its entry is taken into the manifest if so."""
+		entry = self.resumed.get(rel_filepath);
+		if (entry is None or entry.size != st.st_size or entry.mtime != st.st_mtime
+			or not Backup.stored_intact(self.destination, rel_filepath, entry)):
+			return False;
+		self.manifest.add(rel_filepath, entry);
+		self.stats.add(resumed=1);
+		return True;
+
+	def file_stored(self, src_filepath, checksum, storage, st=None):
+		"""Records in the manifest how a copied file was stored, and its checksum
+		in the hash cache. The file is then added to the journal."""
+		rel_filepath = src_filepath[len(self.sources[self.current_source]):].lstrip(os.sep);
+		entry = self.manifest.get(rel_filepath);
+		if entry is not None:
+			if checksum is not None or storage is not None:
+				entry = entry._replace(checksum=checksum, storage=storage);
+				self.manifest.add(rel_filepath, entry);
+			self.journal.add(rel_filepath, entry);
+		if self.hashes is not None and checksum is not None and st is not None:
+			self.hashes.add(rel_filepath, st, checksum);
+
+	def write_manifest(self):
+		"""Saves the manifest into the new version, leaving out any files
+		that failed to copy. Nothing is written if no version was created."""
+		start = len(self.sources[self.current_source]);
+		for src_filepath in self.copy.failed:
+			self.manifest.discard(src_filepath[start:].lstrip(os.sep));
+		if len(self.manifest) > 0:
+			os.makedirs(self.backup_path, exist_ok=True);
+		if os.path.isdir(self.backup_path):
+			os.makedirs(Backup.metadata_path(self.backup_path), exist_ok=True);
+			self.manifest.save(self.backup_path);
+		self.journal.remove();
+		if not os.path.isdir(self.backup_path):
+			try:
+				os.rmdir(Backup.metadata_path(self.backup_path));
+			except OSError:
+				pass;
+		if self.hashes is not None:
+			self.hashes.save();
+
+	@staticmethod
+	def stored_intact(destination, rel_filepath, entry):
+		"""Whether the stored copy of a file is all there, judged by its size
+		without reading it.
+		entry : FileEntry
+			The entry of the file, with the location of its version."""
+		kind = entry.storage[0] if entry.storage else None;
+		target = os.path.join(entry.location, rel_filepath);
+		try:
+			if kind is None:
+				return os.stat(target).st_size == entry.size;
+			elif kind == STORAGE_OBJECT:
+				return os.stat(ObjectStore(destination).object_path(entry.checksum)).st_size == entry.size;
+			elif kind == STORAGE_COMPRESSED:
+				return os.stat(target).st_size > 0 or entry.size == 0;
+			elif kind == STORAGE_PACK:
+				name, offset, length = entry.storage[1:];
+				return os.stat(os.path.join(Backup.metadata_path(entry.location), name)).st_size >= offset + length;
+			elif kind == STORAGE_DELTA:
+				return all(os.path.isfile(p) for p in Delta.paths(entry.location, rel_filepath));
+		except OSError:
+			pass;
+		return False;
+
+	@staticmethod
+	def write_json(path, report):
+		"""Writes a report as JSON, replacing any earlier one at path."""
+		with open(path + ".tmp", "w") as f:
+			json.dump(report, f, indent=1, default=str);
+		os.replace(path + ".tmp", path);
+
+	@staticmethod
+	def copy_out(destination, rel_filepath, entry, target_file):
+		"""Writes a backed up file to target_file however it is stored, with the
+		date modified and permissions it was backed up with.
+		destination : str
+			The destination holding the backups.
+		rel_filepath : str
+			The filepath relative to the version.
+		entry : FileEntry
+			The entry of the file, with the location of its version."""
+		kind = entry.storage[0] if entry.storage else None;
+		if kind == STORAGE_DELTA:
+			Backup.copy_out(destination, rel_filepath, Delta.base_entry(rel_filepath, entry), target_file);
+			Delta.apply(target_file, entry.location, rel_filepath, entry.size);
+		else:
+			with Backup.open_stored(destination, rel_filepath, entry) as src, open(target_file, "wb") as dst:
+				shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE);
+		os.chmod(target_file, stat.S_IMODE(entry.mode));
+		os.utime(target_file, (entry.mtime, entry.mtime));
+
+	@staticmethod
+	def open_stored(destination, rel_filepath, entry):
+		"""Opens a backed up file for reading in binary mode. Files stored as a
+		delta cannot be opened, they have to be rebuilt with copy_out.
+		destination : str
+			The destination holding the backups.
+		rel_filepath : str
+			The filepath relative to the version.
+		entry : FileEntry
+			The entry of the file, with the location of its version."""
+		kind = entry.storage[0] if entry.storage else None;
+		if kind == STORAGE_OBJECT:
+			return ObjectStore(destination).open(entry.checksum);
+		elif kind == STORAGE_COMPRESSED:
+			return COMPRESSORS[entry.storage[1]](os.path.join(entry.location, rel_filepath), "rb");
+		elif kind == STORAGE_PACK:
+			return io.BytesIO(PackWriter.read(entry.location, entry.storage));
+		elif kind is None:
+			return open(os.path.join(entry.location, rel_filepath), "rb");
+		raise ValueError("Cannot open %s stored as %s." % (rel_filepath, kind));
+
+	@staticmethod
+	def file_checksum(filepath):
+		"""The SHA-256 hex digest of the contents of a file."""
+		h = hashlib.sha256();
+		with open(filepath, "rb") as f:
+			for block in iter(lambda: f.read(1024 * 1024), b""):
+				h.update(block);
+		return h.hexdigest();
 
 	@staticmethod
 	def full_version(name):
@@ -230,8 +931,7 @@ class Backup(metaclass=ABCMeta):
 		if not isinstance(name, str):
 			raise TypeError("full_version - The container name must be a string.");
 
-		regex = re.compile(r'^[0-9]{4}-[0-9]{2}-[0-9]{2}_[0-9]{4}__' + TYPE_FULL + r'-([0-9]{1,})$');
-		match = regex.search(name);
+		match = FULL_VERSION_REGEX.search(name);
 		if match:
 			return int(match.group(1));
 		else:
@@ -253,13 +953,46 @@ class Backup(metaclass=ABCMeta):
 		if not isinstance(name, str):
 			raise TypeError("increment_version - The container name must be a string.");
 
-		regex = re.compile(r"^[0-9]{4}-[0-9]{2}-[0-9]{2}_[0-9]{4}__" + TYPE_INCREMENT + "-([0-9]{1,})-([0-9]{1,})$");
-		match = regex.search(name);
+		match = INCREMENT_VERSION_REGEX.search(name);
 		if match:
 			return (int(match.group(1)), int(match.group(2)));
 		else:
 			return None;
 
+	@staticmethod
+	def differential_version(name):
+		"""Extracts the differential version number from the name of the container.
+		Differentials are named YYYY-MM-DD_HHMM__Differential-n-m where n is the
+		full backup version and m is numbered along with the increments of n.
+		Returns : (int, int) or None
+			A pair containing the full backup version number and the differential
+			version number or None if the direcory name is not a differential."""
+		if not isinstance(name, str):
+			raise TypeError("differential_version - The container name must be a string.");
+
+		match = DIFFERENTIAL_VERSION_REGEX.search(name);
+		if match:
+			return (int(match.group(1)), int(match.group(2)));
+		return None;
+
+	@staticmethod
+	def parse_version(name):
+		"""The type and numbers of a version from the name of its container.
+		Returns : (str, int, int or None) or None
+			TYPE_FULL, TYPE_INCREMENT or TYPE_DIFFERENTIAL, the full backup version
+			and the increment or differential version or None for a full backup.
+			None if the name is not a version."""
+		full = Backup.full_version(name);
+		if full is not None:
+			return (TYPE_FULL, full, None);
+		version = Backup.increment_version(name);
+		if version is not None:
+			return (TYPE_INCREMENT,) + version;
+		version = Backup.differential_version(name);
+		if version is not None:
+			return (TYPE_DIFFERENTIAL,) + version;
+		return None;
+
 	@staticmethod
 	def get_all_full_backups(directory):
 		"""Get a list of the full backups in the directory.
@@ -277,16 +1010,10 @@ class Backup(metaclass=ABCMeta):
 			raise TypeError("The directory must be a string.");
 
 		backups = [];
-		if os.path.isdir(directory):
-			for c in os.listdir(directory): #does this raise FileNotFoundError if not dir?
-				fullpath = os.path.join(directory, c);
-				if os.path.isdir(fullpath):
-					version = Backup.full_version(c);
-					if version:
-						backups.append((version, fullpath));
-			backups.sort();
-		#else
-		#TODO: raise error? yes
+		for name, kind, full, inc in Catalog.versions(directory):
+			if kind == TYPE_FULL and full:
+				backups.append((full, os.path.join(directory, name)));
+		backups.sort();
 		return backups;
 
 	@staticmethod
@@ -327,12 +1054,14 @@ class Backup(metaclass=ABCMeta):
 		return lastfull;
 
 	@staticmethod
-	def get_increments_for(directory, version):
+	def get_increments_for(directory, version, kind=TYPE_INCREMENT):
 		"""Get the list of increments for a full backup in the given directory.
 		directory : str
 			The filepath to the directory containing the backup versions.
 		version : int
 			The version number of the full backup.
+		kind : str
+			TYPE_DIFFERENTIAL to list the differentials instead.
 		Returns : [(int, string)]
 			A list of pairs with the increment number and the filepath to the increment."""
 		if not isinstance(directory, str):
@@ -341,21 +1070,10 @@ class Backup(metaclass=ABCMeta):
 			raise TypeError("The version must be an integer.");
 
 		increments = [];
-		if os.path.isdir(directory):
-			for c in os.listdir(directory):
-				fullpath = os.path.join(directory, c);
-				if os.path.isdir(fullpath):
-					inc = Backup.increment_version(c);
-					# inc = (full, increment) or None
-					if inc and inc[0] == version:
-						increments.append((inc[1], fullpath));
-						# (increment_version, filepath)
-			increments.sort();
-			### REVIEW: This is VERY similar code to get full backups
-			### only change is what regex is used and what to append. maybe can simplify
-		else:
-			# REVIEW: Raise error dir does not exit?
-			pass;
+		for name, k, full, inc in Catalog.versions(directory):
+			if k == kind and full == version:
+				increments.append((inc, os.path.join(directory, name)));
+		increments.sort();
 		return increments;
 
 	def dir_datetime(self):
@@ -390,6 +1108,23 @@ class Backup(metaclass=ABCMeta):
 	def new_backup_version(self, destination, backup_name):
 		"""Creates the directory name for a new backup."""
 
+	@abstractmethod
+	def interrupted_version(self, backup_name_path):
+		"""The filepath of the last version of this type if it was interrupted,
+		that is it has a journal but no manifest, or None.
+		Called after new_backup_version."""
+
+	@staticmethod
+	def is_interrupted(version_path):
+		metadata = Backup.metadata_path(version_path);
+		return (os.path.isfile(os.path.join(metadata, JOURNAL_NAME))
+			and not os.path.isfile(os.path.join(metadata, MANIFEST_NAME)));
+
+	@staticmethod
+	def metadata_path(version_path):
+		"""The filepath of the metadata directory of a version, see METADATA_SUFFIX."""
+		return version_path + METADATA_SUFFIX;
+
 class Full(Backup):
 	"""Provides full backup functionality.
 	A full backup copies all files from the given sources to the given destination."""
@@ -397,16 +1132,25 @@ class Full(Backup):
 	def __init__(self):
 		super().__init__();
 		self.C_files = 0;
+		self.link_dest = False;
+		self.previous = None;
 
 	def backup_init(self, src_num):
 		super().backup_init(src_num);
 		self.c_files = 0;
-
-	def backup_file(self, rel_filepath):
-		self.copy.add(os.path.join(self.sources[self.current_source], rel_filepath),
-			os.path.join(self.backup_path, os.path.dirname(rel_filepath)));
+		self.previous = None;
+		if self.link_dest and self.last_full:
+			self.previous = Increment.load_chain([self.last_full]);
+
+	def backup_file(self, rel_filepath, st=None):
+		if st is None:
+			st = self.stat_source(rel_filepath);
+		if st is not None and not self.link_unchanged(rel_filepath, st):
+			self.queue_file(rel_filepath, st);
 		self.c_files += 1;
-		Interface.println("\rFound %s files" % self.c_files, "");
+
+	def progress_line(self):
+		return "Found %d files / Copied %d" % (self.c_files, self.copy.count);
 
 	def new_backup_version(self, destination, backup_name):
 		"""Creates the version name for a new full backup.
@@ -427,16 +1171,57 @@ class Full(Backup):
 			version, path = self.last_full;
 		return "%s__%s-%s" % (self.dir_datetime(), TYPE_FULL, version + 1);
 
+	def interrupted_version(self, backup_name_path):
+		"""The last full backup if interrupted. The full backup before it is
+		then the last full."""
+		if self.last_full is None or not Backup.is_interrupted(self.last_full[1]):
+			return None;
+		interrupted = self.last_full[1];
+		full_backups = Backup.get_all_full_backups(backup_name_path);
+		self.last_full = full_backups[-2] if len(full_backups) > 1 else None;
+		return interrupted;
+
+	def link_unchanged(self, rel_filepath, st):
+		"""When linking to the last full backup, a file with the same size and date
+		modified as its copy there is hard linked into the new version instead
+		of being copied. In the object store the reference is reused.
+		Returns true if the file was linked."""
+		if self.previous is None:
+			return False;
+		entry = self.previous.get(rel_filepath);
+		if entry is None or entry.size != st.st_size or entry.mtime != st.st_mtime:
+			return False;
+		kind = entry.storage[0] if entry.storage else None;
+		if kind == STORAGE_OBJECT:
+			if not self.dedup:
+				return False;
+			self.manifest.add(rel_filepath, entry._replace(location=None));
+			self.copy.linked += 1;
+			self.copy.linked_bytes += entry.size;
+		elif kind is None or (kind == STORAGE_COMPRESSED and entry.storage[1] == self.compression):
+			existing = os.path.join(entry.location, rel_filepath);
+			self.copy.add_link(existing, os.path.join(self.backup_path, os.path.dirname(rel_filepath)),
+				os.path.join(self.sources[self.current_source], rel_filepath), entry.size);
+			self.manifest.add(rel_filepath, FileEntry.from_stat(st, entry.checksum, entry.storage));
+		else:
+			return False;
+		return True;
+
 
 class Increment(Backup):
 	"""Provides incremental backup functionality.
 	An increment compares previous increments and the full backup it relates to
 	only copies files that have been modified to the new increment."""
 
+	TYPE = TYPE_INCREMENT;
+
 	def __init__(self):
 		super().__init__();
 		self.backup_name_path = None;
 		self.all_backups = None;
+		self.chain = None;
+		self.hashing = None;
+		self.hasher = None;
 		self.c_new = 0;
 		self.c_modified = 0;
 		self.c_unmodified = 0;
@@ -444,40 +1229,158 @@ class Increment(Backup):
 	def backup_init(self, src_num):
 		super().backup_init(src_num);
 		self.backup_name_path = os.path.join(self.destination, self.backup_name);
-		self.all_backups = Increment.get_increments_for(self.backup_name_path, self.last_full[0]);
-		self.all_backups.reverse();
-		self.all_backups.append(self.last_full);
+		with self.stats.phase("discovery"):
+			self.all_backups = self.previous_versions();
+		with self.stats.phase("chain"):
+			self.chain = Increment.load_chain(self.all_backups);
+		self.hashing = collections.deque();
 		self.c_new = 0;
 		self.c_modified = 0;
 		self.c_unmodified = 0;
 
-	def backup_file(self, rel_filepath):
+	def previous_versions(self):
+		"""The versions the new increment is compared with, newest first: the
+		increments of the last full backup since its last differential, that
+		differential and the full backup."""
+		versions = [b for b in Backup.get_increments_for(self.backup_name_path, self.last_full[0])
+			if b[1] != self.backup_path];
+		differentials = Backup.get_increments_for(self.backup_name_path, self.last_full[0], TYPE_DIFFERENTIAL);
+		if differentials:
+			versions = [b for b in versions if b[0] > differentials[-1][0]];
+			versions.append(differentials[-1]);
+		versions.sort(reverse=True);
+		versions.append(self.last_full);
+		return versions;
+
+	@staticmethod
+	def load_chain(backups):
+		"""Merges the manifests of a chain of backups into one index holding the
+		latest copy of each file. Versions without a manifest are scanned once,
+		except interrupted ones which only hold the files in their journal, as
+		the others may be half copied.
+		backups : [(int, str)]
+			The versions in the chain, newest first.
+		Returns : FileIndex"""
+		chain = FileIndex();
+		for b_no, b_path in backups:
+			if chain.read_manifest(b_path, replace=False):
+				continue;
+			if Backup.is_interrupted(b_path):
+				for rel, entry in Journal.read(b_path).items():
+					chain.add(rel, entry, replace=False);
+			else:
+				chain.read_tree(b_path, replace=False);
+		return chain;
+
+	def backup_file(self, rel_filepath, st=None):
 		"""Performs an incremental backup of the given sources to the given destination by
 		comparing the source to previous increments and the previous full backup."""
-		found = False;
-		for b_no, b_path in self.all_backups:
-			b_filepath = os.path.join(b_path, rel_filepath);
-			if os.path.isfile(b_filepath):
-				found = True;
-				src_filepath = os.path.join(self.sources[self.current_source], rel_filepath);
-				if self.needs_backup(src_filepath, b_filepath):
-					self.copy.add(src_filepath, os.path.join(self.backup_path,
-						os.path.dirname(rel_filepath)));
-					self.show_progress(2);
-				else:
-					self.show_progress(3);
-				break;
-		if not found:
+		entry = self.chain.get(rel_filepath);
+		if entry is None:
 			self.show_progress(1);
+			return;
+		if st is None:
+			st = self.stat_source(rel_filepath);
+			if st is None:
+				return;
+		if self.hashes is not None and entry.checksum is not None:
+			self.check_checksum(rel_filepath, st, entry);
+		elif self.needs_backup(st, entry):
+			self.queue_file(rel_filepath, st, entry=entry);
+			self.show_progress(2);
+		else:
+			self.show_progress(3);
+
+	def source_walk(self, src_num):
+		"""Walks only the directories changed since the last backup when the
+		change log of a watcher covers all that time, otherwise the whole source."""
+		changes = None;
+		if self.all_backups:
+			since = Increment.started(self.all_backups[0][1]);
+			if since is not None:
+				changes = ChangeLog.changes(os.path.join(self.backup_name_path, CHANGE_LOG_NAME),
+					self.sources[src_num], since - CHANGE_LOG_SLACK);
+		if changes is None:
+			return super().source_walk(src_num);
+		Interface.println("Walking %d changed directories" % len(changes));
+		self.stats.add(changed_directories=len(changes));
+		return self.walk_changes(self.sources[src_num], changes);
+
+	def walk_changes(self, top, changes):
+		"""Walks the changed directories, yielding like walk. Directories that
+		are excluded, or inside one that is, are left out."""
+		for reldir, recursive in sorted(changes.items()):
+			if self.filter is not None:
+				parts = reldir.split(os.sep) if reldir else [];
+				if not all(self.filter.wants_directory(os.sep.join(parts[:i + 1])) for i in range(len(parts))):
+					continue;
+			yield from Backup.walk(top, self.stats, self.filter, reldir, recursive);
 
-	def needs_backup(self, s, b):
-		"""Return true if the file s needs backing up to the new increment
-		compared to the already backed up file b."""
-		return os.path.getmtime(s) > os.path.getmtime(b);
+	@staticmethod
+	def started(version_path):
+		"""When the backup that made a version started, from its report, or None."""
+		try:
+			with open(os.path.join(Backup.metadata_path(version_path), REPORT_NAME), "r") as f:
+				return json.load(f).get("started");
+		except (OSError, ValueError):
+			return None;
+
+	def check_checksum(self, rel_filepath, st, entry):
+		"""Compares the checksum of a source file with its backed up copy.
+		Checksums in the hash cache are used if the file is unchanged since, the
+		others are worked out by a pool of threads and decided in order."""
+		checksum = self.hashes.get(rel_filepath, st);
+		if checksum is not None and not self.hashing:
+			self.checksum_decided(rel_filepath, st, entry, checksum);
+			return;
+		if checksum is None:
+			if self.hasher is None:
+				self.hasher = concurrent.futures.ThreadPoolExecutor(self.jobs);
+			checksum = self.hasher.submit(Backup.file_checksum,
+				os.path.join(self.sources[self.current_source], rel_filepath));
+			self.stats.add(open=1, bytes_read=st.st_size);
+		self.hashing.append((rel_filepath, st, entry, checksum));
+		self.decide_hashed(self.jobs * 8);
+
+	def decide_hashed(self, limit=0):
+		"""Decides the files waiting on their checksum in the order they were found,
+		waiting until no more than limit are left."""
+		while self.hashing:
+			rel_filepath, st, entry, checksum = self.hashing[0];
+			if isinstance(checksum, concurrent.futures.Future):
+				if len(self.hashing) <= limit and not checksum.done():
+					break;
+				try:
+					checksum = checksum.result();
+				except OSError:
+					self.hashing.popleft();
+					self.copy.add_error("Not Found", os.path.join(self.sources[self.current_source], rel_filepath));
+					continue;
+			self.hashing.popleft();
+			self.checksum_decided(rel_filepath, st, entry, checksum);
+
+	def checksum_decided(self, rel_filepath, st, entry, checksum):
+		self.hashes.add(rel_filepath, st, checksum);
+		if checksum != entry.checksum:
+			self.queue_file(rel_filepath, st, checksum, entry);
+			self.show_progress(2);
+		else:
+			self.show_progress(3);
+
+	def files_done(self):
+		self.decide_hashed();
+		if self.hasher is not None:
+			self.hasher.shutdown();
+			self.hasher = None;
+
+	def needs_backup(self, st, entry):
+		"""Return true if the source file with stat st needs backing up to the new
+		increment compared to the already backed up file entry."""
+		return st.st_mtime > entry.mtime;
 
 	def show_progress(self, increase = 0):
-		"""Shows the progress of the increment and adds to the new, modified and
-		unmodified counters if increase is specified.
+		"""Adds to the new, modified and unmodified counters shown in the progress
+		of the increment if increase is specified.
 			When increase is 1: +1 to new
 			     increase is 2: +1 to modified
 				 increase is 3: +1 to unmodified"""
@@ -487,7 +1390,10 @@ class Increment(Backup):
 			self.c_modified += 1;
 		elif increase == 3:
 			self.c_unmodified += 1;
-		Interface.println("\rNew: %d / Modified: %d / Unmodified: %d" % (self.c_new, self.c_modified, self.c_unmodified), "");
+
+	def progress_line(self):
+		return "New: %d / Modified: %d / Unmodified: %d / Copied: %d" % (self.c_new,
+			self.c_modified, self.c_unmodified, self.copy.count);
 
 	def new_backup_version(self, destination, backup_name):
 		"""Creates the version name for a new increment.
@@ -499,65 +1405,2010 @@ class Increment(Backup):
 		# --------------------------------
 		# Incremental backups are named "yyyy-mm-dd_hhmm__Increment-n-m"
 		# where n is the full version number and m is the increment version number.
+		# Differentials are numbered along with the increments.
 		backup_path = os.path.join(destination, backup_name);
 		self.last_full = self.get_last_full_backup(backup_path);
 		if self.last_full == None:
 			raise NoFullBackupError();
 		else:
 			version, path = self.last_full;
-			increments = Increment.get_increments_for(backup_path, version)
-		return "%s__%s-%s-%s" % (self.dir_datetime(), TYPE_INCREMENT, version, len(increments) + 1);
+			numbers = [m for kind in (TYPE_INCREMENT, TYPE_DIFFERENTIAL)
+				for m, p in Backup.get_increments_for(backup_path, version, kind)];
+		return "%s__%s-%s-%s" % (self.dir_datetime(), self.TYPE, version, max(numbers, default=0) + 1);
+
+	def interrupted_version(self, backup_name_path):
+		"""The last increment of the last full backup if interrupted."""
+		increments = Increment.get_increments_for(backup_name_path, self.last_full[0], self.TYPE);
+		if increments and Backup.is_interrupted(increments[-1][1]):
+			return increments[-1][1];
+		return None;
+
+class Differential(Increment):
+	"""Provides differential backup functionality.
+	A differential compares the source to the last full backup only, so it copies
+	every file modified since the full backup and any version can be restored
+	from the full backup and at most one differential."""
+
+	TYPE = TYPE_DIFFERENTIAL;
+
+	def previous_versions(self):
+		return [self.last_full];
+
+class Filter(object):
+	"""Include and exclude glob patterns, compiled once into a regular expression
+	for each kind so a filepath is matched against all of them in one go.
+	A pattern without a / matches the name of a file or directory at any depth,
+	one with a / matches the filepath relative to the source. A * or ? does not
+	match a /, ** matches any number of directories and a trailing / matches
+	directories only, so an include pattern with one includes every file under
+	the directory. Excluded directories are not walked. A file is left out
+	if it is excluded, or if there are include patterns and it matches none.
+	Attributes
+	----------
+	includes : [str]
+	excludes : [str]"""
+
+	def __init__(self, includes=(), excludes=()):
+		self.includes = list(includes);
+		self.excludes = list(excludes);
+		self.compiled = None;
+
+	def __bool__(self):
+		return bool(self.includes or self.excludes);
+
+	def include(self, pattern):
+		self.includes.append(pattern);
+		self.compiled = None;
+
+	def exclude(self, pattern):
+		self.excludes.append(pattern);
+		self.compiled = None;
+
+	def read(self, filepath):
+		"""Adds the patterns in a file, one per line. Lines starting "+ " are
+		include patterns and "- " or no prefix exclude patterns. Blank lines and
+		lines starting # are ignored."""
+		with open(filepath, "r") as f:
+			for line in f:
+				line = line.rstrip("\r\n");
+				if not line.strip() or line.startswith("#"):
+					continue;
+				if line.startswith("+ "):
+					self.include(line[2:]);
+				elif line.startswith("- "):
+					self.exclude(line[2:]);
+				else:
+					self.exclude(line);
+
+	@staticmethod
+	def translate(pattern):
+		"""The regular expression for a glob pattern matched against a whole filepath.
+		A pattern with a trailing / matches everything under the directory."""
+		if pattern.endswith("/"):
+			directory = pattern.rstrip("/");
+			return (Filter.translate(directory) + "/" if directory else "") + ".*";
+		anchored = "/" in pattern;
+		pattern = pattern.lstrip("/");
+		regex = [] if anchored else ["(?:.*/)?"];
+		i = 0;
+		while i < len(pattern):
+			c = pattern[i];
+			if pattern.startswith("**/", i):
+				regex.append("(?:.*/)?");
+				i += 3;
+				continue;
+			elif pattern.startswith("**", i):
+				regex.append(".*");
+				i += 2;
+				continue;
+			elif c == "*":
+				regex.append("[^/]*");
+			elif c == "?":
+				regex.append("[^/]");
+			elif c == "[" and pattern.find("]", i + 2) != -1:
+				j = pattern.find("]", i + 2);
+				chars = pattern[i + 1:j];
+				if chars.startswith("!"):
+					chars = "^" + chars[1:];
+				regex.append("[" + chars.replace("\\", "\\\\") + "]");
+				i = j;
+			else:
+				regex.append(re.escape(c));
+			i += 1;
+		return "".join(regex);
+
+	@staticmethod
+	def combine(patterns):
+		"""One regular expression matching any of the patterns, or None."""
+		if not patterns:
+			return None;
+		return re.compile("(?:%s)\\Z" % "|".join(Filter.translate(p) for p in patterns), re.DOTALL);
+
+	def compile(self):
+		"""Compiles the patterns for files and for directories. Exclude patterns
+		with a trailing / only apply to directories, include patterns with one
+		include the files under the directory."""
+		self.compiled = (Filter.combine([p for p in self.excludes if not p.endswith("/")]),
+			Filter.combine([p.rstrip("/") for p in self.excludes]),
+			Filter.combine(self.includes));
+
+	def wants_file(self, rel_filepath):
+		"""Whether the file at rel_filepath, relative to the source, is backed up."""
+		if self.compiled is None:
+			self.compile();
+		excluded, excluded_dirs, included = self.compiled;
+		if os.sep != "/":
+			rel_filepath = rel_filepath.replace(os.sep, "/");
+		if excluded is not None and excluded.match(rel_filepath):
+			return False;
+		return included is None or included.match(rel_filepath) is not None;
+
+	def wants_directory(self, rel_dirpath):
+		"""Whether the directory at rel_dirpath, relative to the source, is walked."""
+		if self.compiled is None:
+			self.compile();
+		excluded_dirs = self.compiled[1];
+		if os.sep != "/":
+			rel_dirpath = rel_dirpath.replace(os.sep, "/");
+		return excluded_dirs is None or excluded_dirs.match(rel_dirpath) is None;
+
+class ChangeLog(object):
+	"""The directories changed in a source, written by a Watcher. The first line
+	records the source and when watching started, then each line is [time,
+	directory, recursive] where directory is relative to the source and
+	recursive is 1 if everything below it changed too, as for a new directory.
+	An ["overflow"] line means changes were missed. The watcher holds an
+	exclusive flock on the log while it runs, which the system releases when it
+	stops however it stops, so a log that can be locked is no longer kept up.
+	Attributes
+	----------
+	filepath : str
+		Where the log is kept, in the directory of the backup name.
+	source : str
+		The directory being watched."""
+
+	def __init__(self, filepath, source):
+		self.filepath = filepath;
+		self.source = source;
+		self.file = None;
+		self.logged = {};
+
+	def start(self):
+		"""Starts a new log, once the source is being watched. Changes before
+		now are not in it. The log stays locked while it is started again.
+		Raises
+			OSError if another watcher is logging the source, or if the log
+			cannot be locked at all."""
+		if fcntl is None:
+			raise OSError(errno.ENOSYS, "Change logs need flock");
+		if self.file is None:
+			os.makedirs(os.path.dirname(self.filepath), exist_ok=True);
+			self.file = open(self.filepath, "a");
+			try:
+				fcntl.flock(self.file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB);
+			except OSError:
+				self.file.close();
+				self.file = None;
+				raise;
+		self.file.seek(0);
+		self.file.truncate();
+		self.logged = {};
+		self.file.write(json.dumps({"source": self.source, "started": time.time()}) + "\n");
+		self.file.flush();
+
+	def changed(self, reldir, recursive=False):
+		now = time.time();
+		key = (reldir, recursive);
+		if now - self.logged.get(key, 0.0) < CHANGE_LOG_DEDUP:
+			return;
+		self.logged[key] = now;
+		self.file.write(json.dumps([now, reldir, 1 if recursive else 0]) + "\n");
+
+	def overflow(self):
+		self.file.write(json.dumps(["overflow"]) + "\n");
+		self.file.flush();
+
+	def flush(self):
+		self.file.flush();
+		if self.file.tell() > CHANGE_LOG_SIZE:
+			self.start();
+
+	@staticmethod
+	def changes(filepath, source, since):
+		"""The directories changed in source since a time, if the log shows every
+		change since then. That is, the log is for the source, watching started
+		before then, the watcher still holds its lock and nothing was missed.
+		Returns : {str: bool} or None
+			Whether each changed directory changed recursively, or None if the
+			whole source has to be walked."""
+		if fcntl is None:
+			return None;
+		try:
+			f = open(filepath, "r");
+		except OSError:
+			return None;
+		with f:
+			try:
+				fcntl.flock(f.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB);
+				return None; # no watcher holds it
+			except BlockingIOError:
+				pass;
+			except OSError:
+				return None;
+			try:
+				header = json.loads(f.readline());
+			except ValueError:
+				return None;
+			if not isinstance(header, dict) or header.get("source") != source or header.get("started", since) >= since:
+				return None;
+			changes = {};
+			for line in f:
+				try:
+					change = json.loads(line);
+				except ValueError:
+					continue; # being written
+				if change[0] == "overflow":
+					return None;
+				when, reldir, recursive = change;
+				if when >= since:
+					changes[reldir] = changes.get(reldir, False) or bool(recursive);
+		return changes;
+
+class Watcher(object):
+	"""Watches sources for changes with Linux inotify, through ctypes, and
+	records the changed directories in the change log of each source.
+	Every directory of a source is watched, new directories as they appear.
+	If the kernel queue overflows every log is started again, so increments
+	walk the whole of each source once.
+	Attributes
+	----------
+	walk_filter : Filter or None
+		Excluded directories are not watched."""
+
+	IN_MODIFY = 0x2;
+	IN_ATTRIB = 0x4;
+	IN_CLOSE_WRITE = 0x8;
+	IN_MOVED_FROM = 0x40;
+	IN_MOVED_TO = 0x80;
+	IN_CREATE = 0x100;
+	IN_DELETE = 0x200;
+	IN_Q_OVERFLOW = 0x4000;
+	IN_IGNORED = 0x8000;
+	IN_ONLYDIR = 0x1000000;
+	IN_DONT_FOLLOW = 0x2000000;
+	IN_ISDIR = 0x40000000;
+	IN_CLOEXEC = 0o2000000;
+	MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE;
+	EVENT = struct.Struct("iIII");
+
+	def __init__(self, walk_filter=None):
+		if not sys.platform.startswith("linux"):
+			raise OSError(errno.ENOSYS, "inotify is only on Linux");
+		self.walk_filter = walk_filter;
+		self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True);
+		self.fd = self.libc.inotify_init1(Watcher.IN_CLOEXEC);
+		if self.fd < 0:
+			e = ctypes.get_errno();
+			raise OSError(e, os.strerror(e));
+		self.watches = {};
+		self.logs = [];
+
+	def add_source(self, source, backup_name_path):
+		"""Watches every directory of a source and starts its change log."""
+		log = ChangeLog(os.path.join(backup_name_path, CHANGE_LOG_NAME), source);
+		self.logs.append(log);
+		self.watch_tree(log, "");
+		log.start();
+
+	def watch_tree(self, log, reldir):
+		"""Watches a directory and every directory below it. If one cannot be
+		watched, as when out of watches, the log records changes were missed."""
+		for relpath, files in Backup.walk(log.source, None, self.walk_filter, reldir):
+			wd = self.libc.inotify_add_watch(self.fd, os.fsencode(os.path.join(log.source, relpath)),
+				Watcher.MASK | Watcher.IN_ONLYDIR | Watcher.IN_DONT_FOLLOW);
+			if wd < 0:
+				if log.file is not None:
+					log.overflow();
+				else:
+					e = ctypes.get_errno();
+					raise OSError(e, "%s: %s" % (os.strerror(e), os.path.join(log.source, relpath)));
+				continue;
+			self.watches[wd] = (log, relpath);
+
+	def run(self):
+		"""Records changes until interrupted."""
+		while True:
+			self.handle(os.read(self.fd, 64 * 1024));
+
+	def handle(self, data):
+		"""Records the changes in the events read from inotify."""
+		offset = 0;
+		while offset < len(data):
+			wd, mask, cookie, length = Watcher.EVENT.unpack_from(data, offset);
+			name = os.fsdecode(data[offset + Watcher.EVENT.size:offset + Watcher.EVENT.size + length].rstrip(b"\0"));
+			offset += Watcher.EVENT.size + length;
+			if mask & Watcher.IN_Q_OVERFLOW:
+				for log in self.logs:
+					log.overflow();
+					log.start();
+				continue;
+			if wd not in self.watches:
+				continue;
+			log, reldir = self.watches[wd];
+			if mask & Watcher.IN_IGNORED:
+				del self.watches[wd];
+				continue;
+			path = os.path.join(reldir, name);
+			if mask & Watcher.IN_ISDIR:
+				if mask & (Watcher.IN_CREATE | Watcher.IN_MOVED_TO):
+					if self.walk_filter is None or self.walk_filter.wants_directory(path):
+						# Changes made in it before it was watched are found by walking it all.
+						self.watch_tree(log, path);
+						log.changed(path, True);
+				continue;
+			log.changed(reldir);
+		for log in self.logs:
+			log.flush();
+
+class Progress(object):
+	"""Shows a progress line on a timer in a background thread, so the code doing
+	the work only has to add to counters. On a terminal the line is redrawn a
+	few times a second, otherwise, as when logging to a file, a line is written
+	every PROGRESS_LOG_INTERVAL seconds. Nothing is shown when not printing.
+	Can be used as a context manager.
+	Attributes
+	----------
+	line : function
+		Returns the progress line from the counters."""
+
+	def __init__(self, line):
+		self.line = line;
+		self.stopping = threading.Event();
+		self.thread = None;
+		self.tty = sys.stdout.isatty();
+		if __name__ == "__main__" and Interface.verbose:
+			self.thread = threading.Thread(target=self.show, daemon=True);
+			self.thread.start();
+
+	def show(self):
+		interval = PROGRESS_INTERVAL if self.tty else PROGRESS_LOG_INTERVAL;
+		while not self.stopping.wait(interval):
+			if self.tty:
+				Interface.println("\r" + self.line(), "");
+			else:
+				Interface.println(self.line());
+
+	def stop(self):
+		"""Stops the timer and shows the final line."""
+		if self.thread is not None:
+			self.stopping.set();
+			self.thread.join();
+			self.thread = None;
+			Interface.println(("\r" if self.tty else "") + self.line());
+
+	def __enter__(self):
+		return self;
+
+	def __exit__(self, *exc):
+		self.stop();
+
+class Stats(object):
+	"""The timings and counts of backing up a source, cheap enough to always be
+	kept: phases are timed once per directory or per file copied, not per
+	call. Safe to add to from worker threads.
+	Attributes
+	----------
+	phases : {str: float}
+		The seconds spent in each phase. The copy phase adds up the time of
+		every file copied, so with many jobs it can be more than the time taken.
+	counts : collections.Counter
+		Counts of the stat, listdir and open calls and of the bytes read and
+		written.
+	slowest : [(float, str, int)]
+		A heap of the slowest files to copy, as seconds, filepath and size."""
+
+	def __init__(self):
+		self.phases = {};
+		self.counts = collections.Counter();
+		self.slowest = [];
+		self.lock = threading.Lock();
+
+	def add(self, **counts):
+		with self.lock:
+			self.counts.update(counts);
+
+	def add_time(self, name, seconds):
+		with self.lock:
+			self.phases[name] = self.phases.get(name, 0.0) + seconds;
+
+	@contextlib.contextmanager
+	def phase(self, name):
+		"""Times the code in the with block as part of the named phase."""
+		started = time.perf_counter();
+		try:
+			yield;
+		finally:
+			self.add_time(name, time.perf_counter() - started);
+
+	def timed(self, name, iterable):
+		"""Yields from iterable, timing how long each item takes as part of
+		the named phase."""
+		it = iter(iterable);
+		while True:
+			started = time.perf_counter();
+			try:
+				item = next(it);
+			except StopIteration:
+				self.add_time(name, time.perf_counter() - started);
+				return;
+			self.add_time(name, time.perf_counter() - started);
+			yield item;
+
+	def file_copied(self, filepath, seconds, size):
+		"""Adds a file copied, read in full, to the copy phase and the slowest files."""
+		with self.lock:
+			self.phases["copy"] = self.phases.get("copy", 0.0) + seconds;
+			self.counts["bytes_read"] += size;
+			if len(self.slowest) < SLOWEST_FILES:
+				heapq.heappush(self.slowest, (seconds, filepath, size));
+			elif seconds > self.slowest[0][0]:
+				heapq.heapreplace(self.slowest, (seconds, filepath, size));
+
+	def report(self):
+		"""The stats as a dict that can be written as JSON."""
+		with self.lock:
+			return {"phases": dict(self.phases), "counts": dict(self.counts),
+				"slowest": [{"file": f, "seconds": t, "bytes": n} for t, f, n in sorted(self.slowest, reverse=True)],
+				"peak_memory_kb": Stats.peak_memory()};
+
+	@staticmethod
+	def peak_memory():
+		"""The peak resident memory in kilobytes of this process and of the
+		worker processes that have finished, or None when unknown."""
+		if resource is None:
+			return None;
+		peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+			resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss);
+		return peak // 1024 if sys.platform == "darwin" else peak;
+
+class Restore(object):
+	"""Rebuilds the files of a backup as they were at one of its versions.
+	The manifests of the full backup and its increments up to the version are
+	merged in one pass so each file is copied once, from its newest copy.
+	Attributes
+	----------
+	destination : str
+		The destination holding the backups.
+	backup_name : str
+		The name of the backup, the name of the source.
+	jobs : int
+		The number of files to restore at the same time.
+	errors : [str]
+		The files that could not be restored with the reason.
+	"""
+
+	def __init__(self, destination, backup_name, jobs=1):
+		self.destination = destination;
+		self.backup_name = backup_name;
+		self.jobs = max(1, jobs);
+		self.errors = [];
+		self.count = 0;
+
+	def versions(self):
+		"""All the versions of the backup, oldest first.
+		Returns : [(str, int, int, str, str)]
+			The date and time from the name, the full backup version, the increment
+			or differential version or 0 for the full backup, the filepath of the
+			version and its type."""
+		path = os.path.join(self.destination, self.backup_name);
+		versions = [];
+		found = Catalog.versions(path);
+		fulls = {full for name, kind, full, inc in found if kind == TYPE_FULL and full};
+		for name, kind, full, inc in found:
+			if full in fulls:
+				versions.append((name[:15], full, inc or 0, os.path.join(path, name), kind));
+		versions.sort();
+		return versions;
+
+	def find_chain(self, version=None, at=None):
+		"""Finds the versions needed to restore a version.
+		version : str
+			"n" for full backup n or "n-m" for its increment or differential m.
+		at : str
+			The latest version made at or before the date yyyy-mm-dd_hhmm,
+			or any leading part of it such as yyyy-mm-dd.
+		Without either the latest version is restored.
+		Returns : [(int, str)]
+			The full backup, the last differential up to the version and the
+			increments after it up to the version, newest first.
+		Raises
+			NoVersionError if there is no such version."""
+		versions = self.versions();
+		if version is not None:
+			try:
+				wanted = tuple(int(n) for n in version.split("-", 1));
+			except ValueError:
+				raise NoVersionError(version);
+			if len(wanted) == 1:
+				wanted += (0,);
+			versions = [v for v in versions if (v[1], v[2]) == wanted];
+		if at is not None:
+			versions = [v for v in versions if v[0][:len(at)] <= at];
+		if not versions:
+			raise NoVersionError(version or at or self.backup_name);
+		stamp, full, inc, path, kind = versions[-1];
+		versions = [v for v in self.versions() if v[1] == full and v[2] <= inc];
+		differentials = [v[2] for v in versions if v[4] == TYPE_DIFFERENTIAL];
+		if differentials:
+			versions = [v for v in versions if v[2] == 0 or v[2] >= max(differentials)];
+		chain = [(v[2], v[3]) for v in versions];
+		chain.sort(reverse=True);
+		return chain;
+
+	def show_list(self, chain):
+		"""Prints the files in the version at the head of the chain."""
+		for rel, entry in sorted(Increment.load_chain(chain).items()):
+			Interface.println("%s\t%d\t%s" % (rel, entry.size,
+				datetime.fromtimestamp(entry.mtime).strftime("%Y-%m-%d %H:%M:%S")));
+
+	def restore(self, chain, target):
+		"""Restores the version at the head of the chain into the target directory,
+		copying the files in parallel.
+		chain : [(int, str)]
+			The versions from find_chain.
+		target : str
+			The directory to restore into, made if it does not exist."""
+		index = Increment.load_chain(chain);
+		directories = set();
+		pending = collections.deque();
+		progress = Progress(lambda: "Restored %d of %d files" % (self.count, len(index)));
+		with progress, concurrent.futures.ThreadPoolExecutor(self.jobs) as executor:
+			for rel, entry in index.items():
+				target_file = os.path.join(target, rel);
+				directory = os.path.dirname(target_file);
+				if directory not in directories:
+					os.makedirs(directory, exist_ok=True);
+					directories.add(directory);
+				pending.append((rel, executor.submit(Backup.copy_out, self.destination, rel, entry, target_file)));
+				if len(pending) >= self.jobs * 4:
+					self.restored(*pending.popleft());
+			while pending:
+				self.restored(*pending.popleft());
+
+	def restored(self, rel, future):
+		try:
+			future.result();
+			self.count += 1;
+		except (OSError, ValueError) as e:
+			self.errors.append("Restore Failed: %s (%s)" % (rel, e));
+
+	def show_errors(self):
+		for e in self.errors:
+			Interface.printerr(e);
+
+class Verify(Restore):
+	"""Checks that the files of a backup version can be read back intact. Each
+	file the version holds, as it would be restored, is read from its newest
+	copy and hashed by a pool of threads. A file is missing if it cannot be
+	found, corrupt if it does not match the size and checksum recorded in the
+	manifest, and mismatched if it differs from a source file that has not
+	changed since it was backed up.
+	Attributes
+	----------
+	source : str or None
+		The directory that was backed up, to compare the files against.
+	rate : RateLimit
+		Limits the bytes read per second, when a rate is given."""
+
+	PROBLEMS = ("missing", "corrupt", "mismatched");
+
+	def __init__(self, destination, backup_name, jobs=1, source=None, rate=None):
+		super().__init__(destination, backup_name, jobs);
+		self.source = source;
+		self.rate = RateLimit(rate) if rate else None;
+		self.bytes = 0;
+		self.lock = threading.Lock();
+
+	def verify(self, chain, resume=False):
+		"""Verifies the version at the head of the chain. The files checked are
+		recorded as they are done so an interrupted verify can be resumed.
+		chain : [(int, str)]
+			The versions from find_chain.
+		resume : bool
+			Whether to carry on from an earlier verify of the version.
+		Returns : dict
+			The report, with the version, the numbers of files and bytes
+			checked, the seconds taken, the files changed in the source since
+			and the lists of missing, corrupt and mismatched files."""
+		started = time.time();
+		head = chain[0][1];
+		state_path = os.path.join(self.destination, self.backup_name, VERIFY_STATE_PREFIX + os.path.basename(head));
+		report = {"version": os.path.basename(head), "checked": 0, "bytes": 0, "seconds": 0.0, "changed": 0};
+		for problem in Verify.PROBLEMS:
+			report[problem] = [];
+		done = Verify.read_state(state_path, report) if resume else set();
+		index = Increment.load_chain(chain);
+		pending = collections.deque();
+		progress = Progress(lambda: "Verified %d of %d files" % (report["checked"], len(index)));
+		with progress, open(state_path, "a" if resume else "w") as state, \
+			concurrent.futures.ThreadPoolExecutor(self.jobs) as executor:
+			if resume and not Journal.ends_line(state_path):
+				state.write("\n");
+			for rel, entry in index.items():
+				if rel in done:
+					continue;
+				pending.append((rel, executor.submit(self.check, rel, entry)));
+				if len(pending) >= self.jobs * 4:
+					Verify.checked(report, state, *pending.popleft());
+			while pending:
+				Verify.checked(report, state, *pending.popleft());
+		os.remove(state_path);
+		report["bytes"] += self.bytes;
+		report["seconds"] = time.time() - started;
+		return report;
+
+	@staticmethod
+	def checked(report, state, rel, future):
+		"""Adds the result of checking a file to the report and the state."""
+		problem = future.result();
+		Verify.add_result(report, rel, problem);
+		state.write(json.dumps([rel, problem]) + "\n");
+		state.flush();
+
+	@staticmethod
+	def add_result(report, rel, problem):
+		report["checked"] += 1;
+		if problem == "changed":
+			report["changed"] += 1;
+		elif problem is not None:
+			report[problem].append(rel);
+
+	@staticmethod
+	def read_state(state_path, report):
+		"""Adds the results of an earlier verify to the report.
+		Returns : set
+			The files already checked."""
+		done = set();
+		try:
+			f = open(state_path, "r");
+		except FileNotFoundError:
+			return done;
+		with f:
+			for line in f:
+				try:
+					rel, problem = json.loads(line);
+				except ValueError:
+					continue;
+				done.add(rel);
+				Verify.add_result(report, rel, problem);
+		return done;
+
+	def check(self, rel_filepath, entry):
+		"""Checks a backed up file. Safe to call from worker threads.
+		Returns : str or None
+			The problem found, or "changed" if the source changed since it was
+			backed up, or None."""
+		try:
+			checksum, size = self.stored_checksum(rel_filepath, entry);
+		except FileNotFoundError:
+			return "missing";
+		except (OSError, EOFError, ValueError, zlib.error, lzma.LZMAError):
+			return "corrupt";
+		if size != entry.size or (entry.checksum is not None and checksum != entry.checksum):
+			return "corrupt";
+		if self.source is None:
+			return None;
+		source_file = os.path.join(self.source, rel_filepath);
+		try:
+			st = os.stat(source_file);
+			if st.st_size != entry.size or st.st_mtime != entry.mtime:
+				return "changed";
+			with open(source_file, "rb") as f:
+				source_checksum, size = self.hash_file(f);
+		except OSError:
+			return "changed";
+		return "mismatched" if source_checksum != checksum else None;
+
+	def stored_checksum(self, rel_filepath, entry):
+		"""Reads a backed up file however it is stored. Files stored as a delta
+		are read from their base and their changed blocks as they are hashed.
+		Returns : (str, int)
+			The SHA-256 hex digest of the contents and their size."""
+		if entry.storage and entry.storage[0] == STORAGE_DELTA:
+			return self.hash_blocks(Delta.stream(self.destination, rel_filepath, entry));
+		with Backup.open_stored(self.destination, rel_filepath, entry) as f:
+			return self.hash_file(f);
+
+	def hash_file(self, f):
+		"""Hashes an open file in large sequential reads, within the rate limit.
+		Returns : (str, int)
+			The SHA-256 hex digest and the size read."""
+		return self.hash_blocks(iter(lambda: f.read(VERIFY_READ_SIZE), b""));
+
+	def hash_blocks(self, blocks):
+		"""Hashes the blocks of a file, within the rate limit.
+		Returns : (str, int)
+			The SHA-256 hex digest and the size read."""
+		h = hashlib.sha256();
+		size = 0;
+		for block in blocks:
+			if self.rate is not None:
+				self.rate.take(len(block));
+			h.update(block);
+			size += len(block);
+		with self.lock:
+			self.bytes += size;
+		return (h.hexdigest(), size);
+
+	@staticmethod
+	def show_report(report):
+		Interface.println("Verified %s: %d files, %d bytes, %.1fs, %d changed in the source since" % (report["version"],
+			report["checked"], report["bytes"], report["seconds"], report["changed"]));
+		for problem in Verify.PROBLEMS:
+			for rel in report[problem]:
+				Interface.printerr("%s: %s" % (problem.capitalize(), rel));
+
+class Synthesize(Restore):
+	"""Makes a new full backup from a full backup and its increments entirely on
+	the destination, so a new chain can be started without reading the
+	sources. The newest copy of each file is hard linked into the new version,
+	or reflinked or copied where it cannot be linked, and stored as it was.
+	Files in the object store are referred to as they are. Files stored as a
+	delta or in a pack are rebuilt as plain copies, so the new version needs
+	nothing from the old chain.
+	Attributes
+	----------
+	kernel : CopyKernel
+		Copies the files that cannot be linked.
+	linked : int
+		The files hard linked."""
+
+	def __init__(self, destination, backup_name, jobs=1):
+		super().__init__(destination, backup_name, jobs);
+		self.kernel = CopyKernel();
+		self.linked = 0;
+		self.lock = threading.Lock();
+
+	def synthesize(self, chain):
+		"""Makes the new full backup from the versions in the chain. It is built
+		under a name that is not a version and renamed once its manifest is
+		written, so an interrupted synthesize never leaves a version behind.
+		chain : [(int, str)]
+			The versions from find_chain.
+		Returns : dict
+			The report, with the name of the new version or None if any file
+			could not be put in it, the numbers of files and files linked, when
+			the newest version in the chain started and the seconds taken."""
+		started = time.time();
+		backup_name_path = os.path.join(self.destination, self.backup_name);
+		name = Full().new_backup_version(self.destination, self.backup_name);
+		version_path = os.path.join(backup_name_path, name);
+		building = version_path + ".tmp";
+		for path in (building, Backup.metadata_path(building)):
+			if os.path.isdir(path):
+				shutil.rmtree(path);
+		os.makedirs(building);
+		os.makedirs(Backup.metadata_path(building));
+		index = Increment.load_chain(chain);
+		manifest = FileIndex();
+		directories = set();
+		pending = collections.deque();
+		progress = Progress(lambda: "Synthesized %d of %d files" % (self.count, len(index)));
+		with progress, concurrent.futures.ThreadPoolExecutor(self.jobs) as executor:
+			for rel, entry in index.items():
+				directory = os.path.dirname(os.path.join(building, rel));
+				if directory not in directories:
+					os.makedirs(directory, exist_ok=True);
+					directories.add(directory);
+				pending.append((rel, executor.submit(self.place, rel, entry, building)));
+				if len(pending) >= self.jobs * 4:
+					self.placed(manifest, *pending.popleft());
+			while pending:
+				self.placed(manifest, *pending.popleft());
+		report = {"name": self.backup_name, "version": None, "from": [os.path.basename(p) for n, p in chain],
+			"files": self.count, "linked": self.linked, "started": Increment.started(chain[0][1]),
+			"seconds": 0.0};
+		if self.errors:
+			shutil.rmtree(building);
+			shutil.rmtree(Backup.metadata_path(building));
+		else:
+			manifest.save(building);
+			report["version"] = name;
+			# Increments after it look for changes since the newest version it holds.
+			Backup.write_json(os.path.join(Backup.metadata_path(building), REPORT_NAME), report);
+			# The metadata is in place before the version can be seen.
+			os.rename(Backup.metadata_path(building), Backup.metadata_path(version_path));
+			os.rename(building, version_path);
+			Catalog.update(backup_name_path);
+		report["seconds"] = time.time() - started;
+		return report;
+
+	def placed(self, manifest, rel, future):
+		try:
+			manifest.add(rel, future.result());
+			self.count += 1;
+		except (OSError, ValueError) as e:
+			self.errors.append("Synthesize Failed: %s (%s)" % (rel, e));
+
+	def place(self, rel_filepath, entry, version_path):
+		"""Puts a file of the chain into the new version. Safe to call from worker
+		threads.
+		Returns : FileEntry
+			The entry of the file in the new version."""
+		kind = entry.storage[0] if entry.storage else None;
+		if kind == STORAGE_OBJECT:
+			return entry._replace(location=version_path);
+		target = os.path.join(version_path, rel_filepath);
+		if kind is None or kind == STORAGE_COMPRESSED:
+			existing = os.path.join(entry.location, rel_filepath);
+			try:
+				os.link(existing, target);
+				with self.lock:
+					self.linked += 1;
+			except OSError:
+				with open(existing, "rb") as src, open(target, "wb") as dst:
+					self.kernel.copy(src, dst, os.fstat(src.fileno()));
+				shutil.copystat(existing, target);
+			return entry._replace(location=version_path);
+		Backup.copy_out(self.destination, rel_filepath, entry, target);
+		return entry._replace(storage=None, location=version_path);
+
+class RateLimit(object):
+	"""Limits the bytes read per second across threads.
+	Attributes
+	----------
+	rate : int
+		The bytes allowed per second."""
+
+	def __init__(self, rate):
+		self.rate = rate;
+		self.next = time.monotonic();
+		self.lock = threading.Lock();
+
+	def take(self, n):
+		"""Waits until n more bytes can be read."""
+		with self.lock:
+			now = time.monotonic();
+			start = max(self.next, now);
+			self.next = start + n / self.rate;
+		if start > now:
+			time.sleep(start - now);
+
+class FileEntry(collections.namedtuple("FileEntry", "size mtime mode checksum storage location")):
+	"""What is recorded about a backed up file.
+	size : int
+	mtime : float
+		The date modified of the source file when it was backed up.
+	mode : int
+	checksum : str or None
+		The SHA-256 hex digest of the contents, if recorded.
+	storage : list or None
+		How the file is held in the version, None for a plain copy.
+	location : str or None
+		The filepath of the version holding the file, not saved in the manifest."""
+	__slots__ = ();
+
+	@staticmethod
+	def from_stat(st, checksum=None, storage=None, location=None):
+		return FileEntry(st.st_size, st.st_mtime, st.st_mode, checksum, storage, location);
+
+class FileIndex(object):
+	"""Maps filepaths relative to the source to a FileEntry.
+	Entries are grouped by directory so each directory path is only held once.
+	Saved in the metadata of a version as the manifest, one JSON list per line:
+		[rel_filepath, size, mtime, mode, checksum, storage]"""
+
+	def __init__(self):
+		self.dirs = {};
+		self.count = 0;
+
+	def __len__(self):
+		return self.count;
+
+	def add(self, rel_filepath, entry, replace=True):
+		"""Adds an entry. If replace is false an existing entry is kept."""
+		dirname, name = os.path.split(rel_filepath);
+		names = self.dirs.get(dirname);
+		if names is None:
+			names = self.dirs[sys.intern(dirname)] = {};
+		if name not in names:
+			self.count += 1;
+		elif not replace:
+			return;
+		names[name] = entry;
+
+	def get(self, rel_filepath):
+		"""Returns the FileEntry for the filepath or None."""
+		dirname, name = os.path.split(rel_filepath);
+		names = self.dirs.get(dirname);
+		if names is None:
+			return None;
+		return names.get(name);
+
+	def discard(self, rel_filepath):
+		dirname, name = os.path.split(rel_filepath);
+		names = self.dirs.get(dirname);
+		if names is not None and names.pop(name, None) is not None:
+			self.count -= 1;
+
+	def items(self):
+		"""Yields (rel_filepath, FileEntry) pairs."""
+		for dirname, names in self.dirs.items():
+			for name, entry in names.items():
+				yield (os.path.join(dirname, name), entry);
+
+	def save(self, version_path):
+		"""Writes the index as the manifest of the version. The manifest is
+		replaced atomically so it is never seen half written."""
+		filepath = os.path.join(Backup.metadata_path(version_path), MANIFEST_NAME);
+		with open(filepath + ".tmp", "w") as f:
+			f.write(MANIFEST_HEADER + "\n");
+			for rel, e in self.items():
+				f.write(json.dumps([rel, e.size, e.mtime, e.mode, e.checksum, e.storage]) + "\n");
+		os.replace(filepath + ".tmp", filepath);
+
+	def read_manifest(self, version_path, replace=True):
+		"""Adds the entries from the manifest of a version, or from the manifest at
+		its root if it was made before the metadata directory.
+		Returns false if the version has no manifest."""
+		try:
+			f = open(os.path.join(Backup.metadata_path(version_path), MANIFEST_NAME), "r");
+		except FileNotFoundError:
+			try:
+				f = open(os.path.join(version_path, LEGACY_MANIFEST_NAME), "r");
+			except FileNotFoundError:
+				return False;
+		with f:
+			if f.readline().rstrip("\n") != MANIFEST_HEADER:
+				return False;
+			for line in f:
+				rel, size, mtime, mode, checksum, storage = json.loads(line);
+				self.add(rel, FileEntry(size, mtime, mode, checksum, storage, version_path), replace);
+		return True;
+
+	def read_tree(self, version_path, replace=True):
+		"""Adds every file stored in a version by walking it with os.scandir,
+		for versions made before manifests were written."""
+		stack = [""];
+		while stack:
+			reldir = stack.pop();
+			with os.scandir(os.path.join(version_path, reldir)) as it:
+				for e in it:
+					if e.is_dir(follow_symlinks=False):
+						stack.append(os.path.join(reldir, e.name));
+					elif e.is_file():
+						self.add(os.path.join(reldir, e.name),
+							FileEntry.from_stat(e.stat(), location=version_path), replace);
+
+	@staticmethod
+	def load(version_path):
+		"""Returns the manifest of a version as a FileIndex or None."""
+		index = FileIndex();
+		if index.read_manifest(version_path):
+			return index;
+		return None;
+
+class HashCache(object):
+	"""Checksums of the source files of a backup kept between runs. Each is keyed on
+	the relative filepath, size, date modified, inode and status change time
+	of the file so files are only hashed again when these change. The change
+	time catches contents rewritten by tools that put the date modified back.
+	Attributes
+	----------
+	filepath : str
+		Where the cache is saved, in the directory of the backup name."""
+
+	def __init__(self, backup_name_path):
+		self.filepath = os.path.join(backup_name_path, HASH_CACHE_NAME);
+		self.index = FileIndex();
+		self.changed = False;
+		self.lock = threading.Lock();
+		try:
+			with open(self.filepath, "r") as f:
+				for line in f:
+					rel, size, mtime_ns, ino, ctime_ns, checksum = json.loads(line);
+					self.index.add(rel, (size, mtime_ns, ino, ctime_ns, checksum));
+		except FileNotFoundError:
+			pass;
+
+	def get(self, rel_filepath, st):
+		"""The cached checksum of a file or None if not cached or the file changed."""
+		cached = self.index.get(rel_filepath);
+		if cached is not None and cached[:4] == (st.st_size, st.st_mtime_ns, st.st_ino, st.st_ctime_ns):
+			return cached[4];
+		return None;
+
+	def add(self, rel_filepath, st, checksum):
+		with self.lock:
+			self.index.add(rel_filepath, (st.st_size, st.st_mtime_ns, st.st_ino, st.st_ctime_ns, checksum));
+			self.changed = True;
+
+	def save(self):
+		"""Writes the cache if anything was added, replacing the old one atomically."""
+		if not self.changed:
+			return;
+		os.makedirs(os.path.dirname(self.filepath), exist_ok=True);
+		with open(self.filepath + ".tmp", "w") as f:
+			for rel, cached in self.index.items():
+				f.write(json.dumps([rel] + list(cached)) + "\n");
+		os.replace(self.filepath + ".tmp", self.filepath);
+		self.changed = False;
+
+class Catalog(object):
+	"""The versions in the directory of a backup name, kept in a catalog file
+	there and in memory. Both are only used while the directory is unchanged,
+	that is its modified time is no later than when the catalog was written and
+	it has as many links, which counts its subdirectories on POSIX. Otherwise
+	the directory is listed again."""
+
+	# The versions of each directory listed or read in this process, with the
+	# inode, modified time and links of the directory they were found for.
+	cache = {};
+
+	@staticmethod
+	def versions(directory):
+		"""The versions in a directory.
+		Returns : [(str, str, int, int or None)]
+			The name and type of each version, its full backup version and its
+			increment or differential version or None for a full backup. Empty if
+			the directory does not exist."""
+		try:
+			st = os.stat(directory);
+		except OSError:
+			return [];
+		key = (st.st_ino, st.st_mtime_ns, st.st_nlink);
+		cached = Catalog.cache.get(directory);
+		if cached is not None and cached[0] == key:
+			return cached[1];
+		versions = Catalog.read(directory, st);
+		if versions is None:
+			versions = Catalog.scan(directory);
+		Catalog.cache[directory] = (key, versions);
+		return versions;
+
+	@staticmethod
+	def read(directory, st):
+		"""The versions in the catalog file, or None if there is none or the
+		directory changed since it was written."""
+		filepath = os.path.join(directory, CATALOG_NAME);
+		try:
+			if os.stat(filepath).st_mtime_ns < st.st_mtime_ns:
+				return None;
+			with open(filepath, "r") as f:
+				catalog = json.load(f);
+			if catalog["links"] != st.st_nlink:
+				return None;
+			return [(name, kind, full, inc) for name, kind, full, inc in catalog["versions"]];
+		except (OSError, ValueError, KeyError, TypeError):
+			return None;
+
+	@staticmethod
+	def scan(directory):
+		"""Lists the versions in a directory."""
+		versions = [];
+		try:
+			it = os.scandir(directory);
+		except OSError:
+			return versions;
+		with it:
+			for e in it:
+				version = Backup.parse_version(e.name);
+				if version is not None and e.is_dir():
+					versions.append((e.name,) + version);
+		versions.sort();
+		return versions;
+
+	@staticmethod
+	def update(directory):
+		"""Writes the catalog file, replacing it atomically. It is stamped after
+		it is in place, as putting it there changes the directory. Not being
+		able to write it only means the directory is listed next time."""
+		versions = Catalog.versions(directory);
+		filepath = os.path.join(directory, CATALOG_NAME);
+		try:
+			links = os.stat(directory).st_nlink;
+			with open(filepath + ".tmp", "w") as f:
+				json.dump({"links": links, "versions": versions}, f);
+			os.replace(filepath + ".tmp", filepath);
+			os.utime(filepath);
+		except OSError:
+			pass;
+
+class Journal(object):
+	"""Records the files copied into a version as each is done, one line in the
+	manifest format per file, so an interrupted backup can be resumed without
+	copying them again. A line cut short by the interruption is ignored.
+	Safe to add to from worker threads.
+	Attributes
+	----------
+	filepath : str
+		The filepath of the journal, in the metadata of the version."""
+
+	def __init__(self, version_path):
+		self.filepath = os.path.join(Backup.metadata_path(version_path), JOURNAL_NAME);
+		self.file = None;
+		self.unsynced = 0;
+		self.synced = 0.0;
+		self.lock = threading.Lock();
+
+	def start(self):
+		"""Creates the journal, or opens it to carry on with, and syncs it to disk
+		before anything is copied, so a backup interrupted from its first copy
+		on is known to be interrupted."""
+		with self.lock:
+			self.open();
+
+	def open(self):
+		if self.file is not None:
+			return;
+		directory = os.path.dirname(self.filepath);
+		os.makedirs(directory, exist_ok=True);
+		self.file = open(self.filepath, "a");
+		if not Journal.ends_line(self.filepath):
+			self.file.write("\n"); # after a line cut short by an interruption
+		self.file.flush();
+		os.fsync(self.file.fileno());
+		for path in (directory, os.path.dirname(directory)):
+			Journal.sync_directory(path);
+		self.synced = time.monotonic();
+
+	@staticmethod
+	def sync_directory(path):
+		"""Syncs the entries of a directory to disk, where directories can be opened."""
+		if os.name != "posix":
+			return;
+		fd = os.open(path, os.O_RDONLY);
+		try:
+			os.fsync(fd);
+		finally:
+			os.close(fd);
+
+	def add(self, rel_filepath, entry):
+		line = json.dumps([rel_filepath, entry.size, entry.mtime, entry.mode, entry.checksum, entry.storage]) + "\n";
+		with self.lock:
+			self.open();
+			self.file.write(line);
+			self.file.flush();
+			self.unsynced += 1;
+			if self.unsynced >= JOURNAL_SYNC_FILES or time.monotonic() - self.synced >= JOURNAL_SYNC_SECONDS:
+				os.fsync(self.file.fileno());
+				self.unsynced = 0;
+				self.synced = time.monotonic();
+
+	@staticmethod
+	def ends_line(filepath):
+		"""Whether the file is empty or ends with a new line."""
+		with open(filepath, "rb") as f:
+			if f.seek(0, os.SEEK_END) == 0:
+				return True;
+			f.seek(-1, os.SEEK_END);
+			return f.read(1) == b"\n";
+
+	def remove(self):
+		"""Closes and deletes the journal, once the manifest has been written."""
+		with self.lock:
+			if self.file is not None:
+				self.file.close();
+				self.file = None;
+			try:
+				os.remove(self.filepath);
+			except FileNotFoundError:
+				pass;
+
+	@staticmethod
+	def read(version_path):
+		"""Returns the files in the journal of a version as a FileIndex."""
+		index = FileIndex();
+		try:
+			f = open(os.path.join(Backup.metadata_path(version_path), JOURNAL_NAME), "r");
+		except FileNotFoundError:
+			return index;
+		with f:
+			for line in f:
+				try:
+					rel, size, mtime, mode, checksum, storage = json.loads(line);
+				except ValueError:
+					continue;
+				index.add(rel, FileEntry(size, mtime, mode, checksum, storage, version_path));
+		return index;
 
 class Copying(object):
-	"""Handles sequential copying.
+	"""Handles copying, one file at a time or with a number of worker threads.
 	Attributes
 	----------
-	copylist : [str]
-		A list if files to be copied.
+	copylist : CopyList
+		The files to be copied.
+	workers : int
+		The number of files copied at the same time.
 	errors [(str, str)]
 		A list of failed copies with a reason.
+	failed [str]
+		The source files that failed to copy.
+	store : ObjectStore or None
+		Where to put the files instead of the destination directories.
+	checksums : bool
+		Whether to work out the checksum of each file copied.
+	compression : str or None
+		The key in COMPRESSORS to compress copies with.
+	packs : PackWriter or None
+		Where to append files smaller than pack_threshold bytes.
+	version_path : str or None
+		The version copied into, whose metadata holds the deltas.
+	kernel : CopyKernel
+		Copies the data of plain copies.
+	on_stored : function or None
+		Called when a file has been copied.
+	linklist : [(str, str, str, int)]
+		Files already backed up to hard link into the new version instead of
+		copying, with the source file to copy if linking fails and the size.
+	linked, linked_bytes : int
+		The number of files and bytes linked rather than copied.
+	count : int
+		The number of files copied so far.
 	"""
-	def __init__(self):
-		self.copylist = [];
+	def __init__(self, workers=1, store=None, checksums=False, compression=None):
+		self.copylist = CopyList();
+		self.workers = max(1, workers);
+		self.store = store;
+		self.checksums = checksums;
+		self.compression = compression;
+		self.packs = None;
+		self.pack_threshold = 0;
+		self.version_path = None;
+		self.kernel = CopyKernel();
+		self.stats = Stats();
+		self.on_stored = None;
+		self.linklist = [];
+		self.linked = 0;
+		self.linked_bytes = 0;
+		self.count = 0;
+		self.queue = None;
+		self.copier = None;
+		self.failure = None;
 		self.errors = [];
+		self.failed = [];
+		self.directories = set();
+
+	def add(self, source_file, destination_file, st=None, base=None):
+		"""Adds a file to copy into a destination directory, with the stat of
+		the source file if already known. If base is given only the blocks
+		changed since a backed up copy are stored, see Delta.
+		base : (str, str, FileEntry)
+			The destination, the relative filepath and the entry of the copy."""
+		if self.queue is not None:
+			# Only the filepaths are kept once copying has begun.
+			self.copylist.append((source_file, destination_file, None, None));
+			self.queue.put((source_file, destination_file, st, base));
+		else:
+			self.copylist.append((source_file, destination_file, st, base));
 
-	def add(self, source_file, destination_file):
-		self.copylist.append((source_file, destination_file));
+	def add_link(self, existing_file, destination_directory, source_file, size):
+		self.linklist.append((existing_file, destination_directory, source_file, size));
 
 	def add_error(self, msg, src):
-		self.errors.append("%s: %s" % msg, src);
+		self.errors.append("%s: %s" % (msg, src));
+		self.failed.append(src);
 
 	def show_errors(self):
 		for e in self.errors:
 			Interface.printerr(e);
 
 	def start(self):
-		c = 0;
-		for s, d in self.copylist:
-			self.copy_file(s, d);
-			c += 1;
-			Interface.println("\rCopied %d of %d" % (c, len(self.copylist)), "");
-		if c > 0:
-			Interface.println("\nCopying Complete");
+		"""Copies everything in the copylist."""
+		self.begin();
+		self.finish();
+		self.show_count();
+
+	def begin(self):
+		"""Starts copying in a background thread. Files added from now on are
+		copied as they arrive, through a bounded queue so adding waits when
+		copying falls behind. Files already in the copylist are copied first."""
+		self.queue = queue.Queue(COPY_QUEUE_SIZE);
+		self.copier = threading.Thread(target=self.copy_queued,
+			args=(self.copylist.snapshot(),), daemon=True);
+		self.copier.start();
+
+	def copy_queued(self, backlog):
+		try:
+			for result in self.copy_all(itertools.chain(backlog, iter(self.queue.get, None))):
+				self.copied(*result);
+				self.count += 1;
+		except BaseException as e:
+			self.failure = e;
+			# Keep taking from the queue so adding files does not block.
+			for item in iter(self.queue.get, None):
+				pass;
+
+	def finish(self):
+		"""Waits for the queued files to be copied then links the linklist.
+		Raises any error that stopped the copying thread."""
+		self.queue.put(None);
+		self.copier.join();
+		self.queue = None;
+		if self.failure is not None:
+			failure, self.failure = self.failure, None;
+			raise failure;
+		self.link_all();
+		if self.packs is not None:
+			self.packs.close();
+
+	def show_count(self):
+		"""Prints the number of files copied."""
+		if self.count > 0:
+			Interface.println("Copied %d files\nCopying Complete" % self.count);
 		else:
 			Interface.println("No Files To Copy");
 
-	def copy_file(self, source_file, destination_directory):
+	def link_all(self):
+		"""Hard links the files in the linklist. Files that cannot be linked, for
+		example across filesystems, are copied from the source instead."""
+		unlinked = [];
+		for existing, d, s, size in self.linklist:
+			self.make_directory(d);
+			link = os.path.join(d, os.path.basename(existing));
+			try:
+				try:
+					os.link(existing, link);
+				except FileExistsError:
+					# Linked before a resumed backup was interrupted.
+					if not os.path.samefile(existing, link):
+						raise;
+				self.linked += 1;
+				self.linked_bytes += size;
+			except OSError:
+				unlinked.append((s, d, None, None));
+		if self.linked > 0:
+			Interface.println("Linked %d unchanged files" % self.linked);
+		self.copylist.extend(unlinked);
+		for result in self.copy_all(unlinked):
+			self.copied(*result);
+			self.count += 1;
+
+	def copied(self, source_file, error, stored, st=None):
+		"""Records the result of a copy. If the file was copied on_stored is called
+		with the source file, the checksum, the storage and the stat of the
+		source, where the checksum and storage are None for a plain copy
+		without a checksum."""
+		if error:
+			self.add_error(error, source_file);
+		elif self.on_stored:
+			checksum, storage = stored or (None, None);
+			self.on_stored(source_file, checksum, storage, st);
+
+	def copy_all(self, copies):
+		"""Copies each (source_file, destination_directory, stat, base) in copies.
+		Yields (source_file, error, stored, stat) in the order given, where error is None
+		if the copy succeeded and stored is None for a plain copy or a pair of
+		(checksum, storage). At most a few copies per worker are in flight."""
+		if self.workers == 1:
+			for s, d, st, base in copies:
+				self.make_directory(d, base, st.st_size if st else None);
+				yield (s,) + self.timed_copy(s, d, st, base) + (st,);
+			return;
+		pending = collections.deque();
+		with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+			for s, d, st, base in copies:
+				self.make_directory(d, base, st.st_size if st else None);
+				pending.append((s, st, executor.submit(self.timed_copy, s, d, st, base)));
+				if len(pending) >= self.workers * 4:
+					s, st, f = pending.popleft();
+					yield (s,) + f.result() + (st,);
+			while pending:
+				s, st, f = pending.popleft();
+				yield (s,) + f.result() + (st,);
+
+	def make_directory(self, directory, base=None, size=None):
+		"""Creates a destination directory the first time it is needed.
+		Not needed when copying into an object store, unless storing a delta,
+		or for a file of size bytes that goes in a pack.
+		Raises OSError if the directory cannot be created."""
+		if self.packs is not None and size is not None and size < self.pack_threshold and base is None:
+			return;
+		if directory not in self.directories and (self.store is None or base is not None):
+			os.makedirs(directory, exist_ok=True);
+			self.directories.add(directory);
+
+	def copy_file(self, source_file, destination_directory, st=None):
 		"""Copies a source file to the destination directory.
 		Also copies file stats such as date modified.
 		If it cannot be copied it will be added to the errors list."""
-		# REVIEW: Does copy2 overwrite existing files.
-		if not os.path.exists(destination_directory):
-			os.makedirs(destination_directory);
-			# raises OSError if directory cannot be created.
+		self.make_directory(destination_directory);
+		self.copied(source_file, *self.try_copy(source_file, destination_directory, st), st=st);
+
+	def timed_copy(self, source_file, destination_directory, st=None, base=None):
+		"""Calls try_copy, adding the time taken to the copy phase of the stats."""
+		started = time.perf_counter();
+		result = self.try_copy(source_file, destination_directory, st, base);
+		self.stats.file_copied(source_file, time.perf_counter() - started,
+			st.st_size if st is not None and result[0] is None else 0);
+		return result;
+
+	def try_copy(self, source_file, destination_directory, st=None, base=None):
+		"""Copies a source file into an existing destination directory, or into
+		the object store if there is one. Safe to call from worker threads.
+		When the stat of the source is given it is used for the date modified
+		and permissions instead of stat'ing the file again. With checksums the
+		contents are hashed as they are copied, otherwise plain copies are made
+		by the CopyKernel. A file is copied whole if the base of its delta
+		cannot be read.
+		Returns : (str, (str, list))
+			The reason the copy failed or None, and the checksum and storage
+			or None for a plain copy without a checksum."""
+		stored = None;
+		base_sums = None;
+		if base is not None:
+			destination, rel_filepath, entry = base;
+			try:
+				base_sums = Delta.base_sums(destination, rel_filepath, entry, self.stats);
+			except (OSError, EOFError, ValueError, zlib.error, lzma.LZMAError):
+				base_sums = None; # The base cannot be read, copy the whole file.
 		try:
-			shutil.copy2(source_file, destination_directory);
+			if base_sums is not None:
+				h = hashlib.sha256() if self.checksums else None;
+				written = Delta.write(source_file, self.version_path, rel_filepath, base_sums, h);
+				self.stats.add(open=3, bytes_written=written);
+				stored = (h.hexdigest() if h else None, [STORAGE_DELTA, os.path.basename(entry.location)]);
+			elif self.store is not None:
+				stored = (self.store.put(source_file, self.stats), [STORAGE_OBJECT]);
+			elif self.packs is not None and (st or os.stat(source_file)).st_size < self.pack_threshold:
+				with open(source_file, "rb") as src:
+					data = src.read();
+				stored = (hashlib.sha256(data).hexdigest() if self.checksums else None, self.packs.append(data));
+				self.stats.add(open=1, bytes_written=len(data));
+			else:
+				if st is None:
+					self.stats.add(stat=1);
+					st = os.stat(source_file);
+				target = os.path.join(destination_directory, os.path.basename(source_file));
+				storage = None;
+				open_target = open;
+				if self.compression is not None and Copying.compressible(source_file):
+					# Kept under the name of the file, the manifest records how it is compressed.
+					storage = [STORAGE_COMPRESSED, self.compression];
+					open_target = COMPRESSORS[self.compression];
+				h = hashlib.sha256() if self.checksums else None;
+				with open(source_file, "rb") as src, open_target(target, "wb") as dst:
+					if h is None and storage is None:
+						self.kernel.copy(src, dst, st);
+					else:
+						for block in iter(lambda: src.read(self.kernel.buffer_size), b""):
+							dst.write(block);
+							if h is not None:
+								h.update(block);
+				self.stats.add(open=2, bytes_written=st.st_size if storage is None else os.path.getsize(target));
+				os.chmod(target, stat.S_IMODE(st.st_mode));
+				os.utime(target, ns=(st.st_atime_ns, st.st_mtime_ns));
+				if h is not None or storage is not None:
+					stored = (h.hexdigest() if h else None, storage);
 		except PermissionError:
-			self.add_error("Permission Denied", source_file);
+			return ("Permission Denied", None);
 		except FileNotFoundError:
-			self.add_error("Not Found", source_file);
-		except (shutil.Error, OSError) as e:
-			self.add_error("Copy Failed", source_file);
+			return ("Not Found", None);
+		except (shutil.Error, OSError, ValueError) as e:
+			return ("Copy Failed", None);
+		return (None, stored);
+
+	@staticmethod
+	def compressible(filepath):
+		"""Whether compressing a file is worthwhile, false for files such as media
+		and archives whose contents are already compressed."""
+		return os.path.splitext(filepath)[1].lower() not in COMPRESS_SKIP;
+
+class CopyList(object):
+	"""The files to be copied, held compactly so millions of them fit in memory.
+	Each directory is held once and numbered. A file is the numbers of its
+	source and destination directories and the end of its name in arrays, with
+	the names encoded one after another. The stat of a file, when given, is
+	held as its numbers in an array, and the delta base, when given, in a list.
+	Past memory_limit bytes all of these are written out to a temporary file and
+	started again. Like the list of tuples it replaces, it is appended
+	(source_file, destination_directory, stat, base) and yields them in order.
+	Attributes
+	----------
+	memory_limit : int
+		The bytes held in memory before they are written out."""
+
+	# The numbers of a stat that are kept, and those that are unsigned.
+	STAT_FIELDS = ("st_mode", "st_ino", "st_dev", "st_nlink", "st_uid", "st_gid", "st_size",
+		"st_atime_ns", "st_mtime_ns", "st_ctime_ns");
+	UNSIGNED = (1, 2);
+	# Each file has flags for whether its stat and its base are held.
+	HAS_STAT = 1;
+	HAS_BASE = 2;
+	# A rough size of a delta base held in the list.
+	BASE_SIZE = 256;
+
+	def __init__(self, memory_limit=COPY_LIST_MEMORY):
+		self.memory_limit = memory_limit;
+		self.directories = {};
+		self.paths = [];
+		self.count = 0;
+		self.spill = None;
+		self.chunks = [];
+		self.lock = threading.Lock();
+		self.clear_arrays();
+
+	def clear_arrays(self):
+		"""Starts new arrays, leaving the old ones as they are for any snapshot
+		still reading them."""
+		self.sources = array.array("I");
+		self.destinations = array.array("I");
+		self.ends = array.array("Q");
+		self.names = bytearray();
+		self.flags = bytearray();
+		self.stats = array.array("q");
+		self.bases = [];
+
+	def __len__(self):
+		return self.count;
+
+	def directory(self, path):
+		"""The number of a directory, numbering it the first time it is seen."""
+		n = self.directories.get(path);
+		if n is None:
+			n = self.directories[path] = len(self.paths);
+			self.paths.append(path);
+		return n;
+
+	def append(self, copy):
+		source_file, destination_directory, st, base = copy;
+		source_directory, name = os.path.split(source_file);
+		flags = 0;
+		with self.lock:
+			self.sources.append(self.directory(source_directory));
+			self.destinations.append(self.directory(destination_directory));
+			self.names += os.fsencode(name);
+			self.ends.append(len(self.names));
+			if st is not None:
+				flags |= CopyList.HAS_STAT;
+				self.stats.extend(CopyList.pack_stat(st));
+			if base is not None:
+				flags |= CopyList.HAS_BASE;
+				self.bases.append(base);
+			self.flags.append(flags);
+			self.count += 1;
+			if self.memory() > self.memory_limit:
+				self.write_out();
+
+	def extend(self, copies):
+		for copy in copies:
+			self.append(copy);
+
+	@staticmethod
+	def pack_stat(st):
+		values = [getattr(st, f) for f in CopyList.STAT_FIELDS];
+		for i in CopyList.UNSIGNED:
+			if values[i] >= 1 << 63:
+				values[i] -= 1 << 64;
+		return values;
+
+	@staticmethod
+	def unpack_stat(values):
+		"""Makes an os.stat_result from the numbers kept by pack_stat, with the
+		times in seconds worked out as os.stat does."""
+		values = list(values);
+		for i in CopyList.UNSIGNED:
+			if values[i] < 0:
+				values[i] += 1 << 64;
+		times = values[7:10];
+		return os.stat_result(values[:7] + [t // 10 ** 9 for t in times]
+			+ [t // 10 ** 9 + (t % 10 ** 9) * 1e-9 for t in times] + times);
+
+	def memory(self):
+		"""The bytes held in memory, roughly for the bases."""
+		return (len(self.names) + len(self.flags) + len(self.stats) * self.stats.itemsize
+			+ len(self.ends) * (self.sources.itemsize + self.destinations.itemsize + self.ends.itemsize)
+			+ len(self.bases) * CopyList.BASE_SIZE);
+
+	def write_out(self):
+		"""Writes what is held to the temporary file and starts again.
+		Called with the lock held."""
+		if self.spill is None:
+			self.spill = tempfile.TemporaryFile();
+		self.spill.seek(0, os.SEEK_END);
+		bases = json.dumps([[d, rel, list(entry)] for d, rel, entry in self.bases]).encode();
+		self.chunks.append((self.spill.tell(), len(self.ends), len(self.names), len(self.stats), len(bases)));
+		for a in (self.sources, self.destinations, self.ends, self.stats):
+			a.tofile(self.spill);
+		self.spill.write(self.flags);
+		self.spill.write(self.names);
+		self.spill.write(bases);
+		self.clear_arrays();
+
+	def read_chunk(self, offset, count, size, stats_count, bases_size):
+		"""Reads what write_out wrote."""
+		with self.lock:
+			self.spill.flush();
+			self.spill.seek(offset);
+			arrays = (array.array("I"), array.array("I"), array.array("Q"), array.array("q"));
+			for a, n in zip(arrays, (count, count, count, stats_count)):
+				a.fromfile(self.spill, n);
+			flags = self.spill.read(count);
+			names = self.spill.read(size);
+			bases = [(d, rel, FileEntry(*entry)) for d, rel, entry in json.loads(self.spill.read(bases_size).decode())];
+		sources, destinations, ends, stats = arrays;
+		return (sources, destinations, ends, names, flags, stats, bases, count);
+
+	def __iter__(self):
+		return self.snapshot();
+
+	def snapshot(self):
+		"""An iterator over the files added so far, which can be used while
+		more are added."""
+		with self.lock:
+			chunks = list(self.chunks);
+			held = (self.sources, self.destinations, self.ends, self.names, self.flags,
+				self.stats, self.bases, len(self.ends));
+		return self.files(chunks, held);
+
+	def files(self, chunks, held):
+		for i in range(len(chunks) + 1):
+			sources, destinations, ends, names, flags, stats, bases, count = (self.read_chunk(*chunks[i])
+				if i < len(chunks) else held);
+			start = 0;
+			s = 0;
+			b = 0;
+			n = len(CopyList.STAT_FIELDS);
+			for j in range(count):
+				st = None;
+				base = None;
+				if flags[j] & CopyList.HAS_STAT:
+					st = CopyList.unpack_stat(stats[s:s + n]);
+					s += n;
+				if flags[j] & CopyList.HAS_BASE:
+					base = bases[b];
+					b += 1;
+				end = ends[j];
+				yield (os.path.join(self.paths[sources[j]], os.fsdecode(bytes(names[start:end]))),
+					self.paths[destinations[j]], st, base);
+				start = end;
+
+class CopyKernel(object):
+	"""Copies the data of a file by the fastest method the source and destination
+	filesystems allow, trying in order: a reflink sharing the source blocks
+	(FICLONE on btrfs and XFS), os.copy_file_range, os.sendfile and finally
+	reading and writing through a buffer. The method that works for a pair of
+	filesystems is remembered so the others are not tried again for it. The
+	destination is preallocated before copying so it is not fragmented.
+	Attributes
+	----------
+	buffer_size : int
+		The size of the reads for the buffered copy.
+	bytes : {str: int}
+		The bytes copied by each method."""
+
+	METHODS = ("reflink", "copy_file_range", "sendfile", "buffered");
+	# Raised when a method is not supported for the files given.
+	UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL};
+	FICLONE = 0x40049409;
+
+	def __init__(self, buffer_size=COPY_BUFFER_SIZE):
+		self.buffer_size = buffer_size;
+		self.best = {};
+		self.bytes = {};
+		self.lock = threading.Lock();
+
+	def copy(self, src, dst, st):
+		"""Copies everything from the file src to the empty file dst, both open
+		in binary mode. st is the stat of the source.
+		Safe to call from worker threads."""
+		src_fd = src.fileno();
+		dst_fd = dst.fileno();
+		pair = (st.st_dev, os.fstat(dst_fd).st_dev);
+		for i in range(self.best.get(pair, 0), len(CopyKernel.METHODS)):
+			method = CopyKernel.METHODS[i];
+			if method != "reflink" and st.st_size > 0 and hasattr(os, "posix_fallocate"):
+				try:
+					os.posix_fallocate(dst_fd, 0, st.st_size);
+				except OSError:
+					pass;
+			try:
+				copied = getattr(self, method)(src_fd, dst_fd, st.st_size);
+			except OSError as e:
+				if e.errno not in CopyKernel.UNSUPPORTED or method == "buffered":
+					raise;
+				copied = None;
+			if copied is not None:
+				if method != "reflink":
+					os.ftruncate(dst_fd, copied); # in case the source shrank
+				self.best[pair] = i;
+				with self.lock:
+					self.bytes[method] = self.bytes.get(method, 0) + copied;
+				return;
+			# Start again with the next method.
+			os.lseek(src_fd, 0, os.SEEK_SET);
+			os.lseek(dst_fd, 0, os.SEEK_SET);
+			os.ftruncate(dst_fd, 0);
+
+	def reflink(self, src_fd, dst_fd, size):
+		if fcntl is None:
+			return None;
+		fcntl.ioctl(dst_fd, CopyKernel.FICLONE, src_fd);
+		return size;
+
+	def copy_file_range(self, src_fd, dst_fd, size):
+		if not hasattr(os, "copy_file_range"):
+			return None;
+		copied = 0;
+		while True:
+			n = os.copy_file_range(src_fd, dst_fd, max(size - copied, self.buffer_size));
+			if n == 0:
+				break;
+			copied += n;
+		# Some filesystems (procfs, sysfs, some FUSE) report nothing copied for
+		# files with contents, which is a sign the method does not work there.
+		return None if copied == 0 and size > 0 else copied;
+
+	def sendfile(self, src_fd, dst_fd, size):
+		if not hasattr(os, "sendfile") or sys.platform != "linux":
+			return None;
+		copied = 0;
+		while True:
+			n = os.sendfile(dst_fd, src_fd, copied, max(size - copied, self.buffer_size));
+			if n == 0:
+				break;
+			copied += n;
+		return None if copied == 0 and size > 0 else copied;
+
+	def buffered(self, src_fd, dst_fd, size):
+		copied = 0;
+		buffer = bytearray(self.buffer_size);
+		view = memoryview(buffer);
+		with open(src_fd, "rb", buffering=0, closefd=False) as src:
+			while True:
+				n = src.readinto(buffer);
+				if not n:
+					break;
+				written = 0;
+				while written < n:
+					written += os.write(dst_fd, view[written:n]);
+				copied += n;
+		return copied;
+
+class Delta(object):
+	"""Stores a large file as the blocks that changed since its last backed up copy.
+	The file is read in blocks of DELTA_BLOCK_SIZE and each block is compared
+	by checksum with the block at the same offset in the copy, so changes made
+	in place, as to disk images and databases, only store the blocks touched.
+	Beside the delta of changed blocks the blocks file records the checksum of
+	every block of the new file, so the next delta is worked out without
+	reading any backups. Both are kept in the metadata of the version."""
+
+	@staticmethod
+	def block_checksum(block):
+		return hashlib.blake2b(block, digest_size=16).hexdigest();
+
+	@staticmethod
+	def base_entry(rel_filepath, entry):
+		"""The entry of the copy a file stored as a delta was worked out against.
+		Raises FileNotFoundError if its version does not hold the file."""
+		base_path = os.path.join(os.path.dirname(entry.location), entry.storage[1]);
+		base = FileIndex.load(base_path);
+		if base is not None:
+			base = base.get(rel_filepath);
+		elif os.path.isfile(os.path.join(base_path, rel_filepath)):
+			# A version made before manifests holds plain copies.
+			base = FileEntry.from_stat(os.stat(os.path.join(base_path, rel_filepath)), location=base_path);
+		if base is None:
+			raise FileNotFoundError("No base copy of %s in %s" % (rel_filepath, base_path));
+		return base;
+
+	@staticmethod
+	def stream(destination, rel_filepath, entry):
+		"""Yields the contents of a file stored as a delta, block by block, from
+		its base with the changed blocks put over it, without writing it out.
+		Bases that are deltas themselves are streamed the same way."""
+		blocks = Delta.read_blocks(entry.location, rel_filepath);
+		block_size = blocks["block_size"];
+		changed = set(blocks["changed"]);
+		delta_path = Delta.paths(entry.location, rel_filepath)[0];
+		with contextlib.ExitStack() as stack:
+			base = Delta.base_entry(rel_filepath, entry);
+			if base.storage and base.storage[0] == STORAGE_DELTA:
+				chunks = Delta.stream(destination, rel_filepath, base);
+			else:
+				f = stack.enter_context(Backup.open_stored(destination, rel_filepath, base));
+				chunks = iter(lambda: f.read(block_size), b"");
+			delta = stack.enter_context(open(delta_path, "rb"));
+			pending = b"";
+			for offset in range(0, entry.size, block_size):
+				n = min(block_size, entry.size - offset);
+				while len(pending) < n:
+					chunk = next(chunks, b"");
+					if not chunk:
+						break;
+					pending += chunk;
+				block, pending = pending[:n], pending[n:];
+				if offset // block_size in changed:
+					block = delta.read(n);
+				yield block;
+
+	@staticmethod
+	def paths(version_path, rel_filepath):
+		"""The filepaths of the delta and the blocks file of a file in a version.
+		Returns : (str, str)"""
+		metadata = Backup.metadata_path(version_path);
+		return (os.path.join(metadata, DELTAS_DIR, rel_filepath), os.path.join(metadata, BLOCKS_DIR, rel_filepath));
+
+	@staticmethod
+	def read_blocks(version_path, rel_filepath):
+		"""Loads the blocks file of a file stored as a delta in a version."""
+		with open(Delta.paths(version_path, rel_filepath)[1], "r") as f:
+			return json.load(f);
+
+	@staticmethod
+	def base_sums(destination, rel_filepath, entry, stats=None):
+		"""The checksum of each block of a backed up file, read from its blocks
+		file if stored as a delta or worked out by reading it if not.
+		stats : Stats
+			Counts the file opened and the bytes read, if given."""
+		if entry.storage and entry.storage[0] == STORAGE_DELTA:
+			blocks = Delta.read_blocks(entry.location, rel_filepath);
+			if stats is not None:
+				stats.add(open=1);
+			if blocks["block_size"] == DELTA_BLOCK_SIZE:
+				return blocks["sums"];
+			return [];
+		sums = [];
+		size = 0;
+		with Backup.open_stored(destination, rel_filepath, entry) as f:
+			for block in iter(lambda: f.read(DELTA_BLOCK_SIZE), b""):
+				sums.append(Delta.block_checksum(block));
+				size += len(block);
+		if stats is not None:
+			stats.add(open=1, bytes_read=size);
+		return sums;
+
+	@staticmethod
+	def write(source_file, version_path, rel_filepath, base_sums, h=None):
+		"""Writes the blocks of source_file that differ from base_sums to its
+		delta in the version and the checksum of every block to its blocks file.
+		h : hashlib hash
+			Updated with the whole contents of the source file if given.
+		Returns : int
+			The bytes of changed blocks written."""
+		written = 0;
+		sums = [];
+		changed = [];
+		delta_path, blocks_path = Delta.paths(version_path, rel_filepath);
+		for path in (delta_path, blocks_path):
+			os.makedirs(os.path.dirname(path), exist_ok=True);
+		with open(source_file, "rb") as src, open(delta_path, "wb") as dst:
+			for i, block in enumerate(iter(lambda: src.read(DELTA_BLOCK_SIZE), b"")):
+				checksum = Delta.block_checksum(block);
+				sums.append(checksum);
+				if h is not None:
+					h.update(block);
+				if i >= len(base_sums) or base_sums[i] != checksum:
+					changed.append(i);
+					written += dst.write(block);
+		with open(blocks_path + ".tmp", "w") as f:
+			json.dump({"block_size": DELTA_BLOCK_SIZE, "sums": sums, "changed": changed}, f);
+		os.replace(blocks_path + ".tmp", blocks_path);
+		return written;
+
+	@staticmethod
+	def apply(target_file, version_path, rel_filepath, size):
+		"""Writes the changed blocks of the delta of a file in a version over
+		the rebuilt previous copy in target_file, which is cut to size."""
+		blocks = Delta.read_blocks(version_path, rel_filepath);
+		block_size = blocks["block_size"];
+		with open(target_file, "r+b") as out, open(Delta.paths(version_path, rel_filepath)[0], "rb") as delta:
+			for i in blocks["changed"]:
+				out.seek(i * block_size);
+				out.write(delta.read(min(block_size, size - i * block_size)));
+			out.truncate(size);
+
+class PackWriter(object):
+	"""Appends small files to pack files in the metadata of a version, so
+	each costs a write to an open file rather than a file of its own. A new pack
+	is started once a pack reaches PACK_SIZE. Where each file went is kept in
+	the manifest as [STORAGE_PACK, pack, offset, length].
+	Attributes
+	----------
+	version_path : str
+		The filepath of the version the packs are in."""
+
+	def __init__(self, version_path):
+		self.version_path = version_path;
+		self.number = 0;
+		self.name = None;
+		self.file = None;
+		self.offset = 0;
+		self.lock = threading.Lock();
+
+	def append(self, data):
+		"""Appends the contents of a file. Safe to call from worker threads.
+		Returns : list
+			The storage of the file for the manifest."""
+		with self.lock:
+			if self.file is None or (self.offset > 0 and self.offset + len(data) > PACK_SIZE):
+				self.start_pack();
+			self.file.write(data);
+			storage = [STORAGE_PACK, self.name, self.offset, len(data)];
+			self.offset += len(data);
+		return storage;
+
+	def start_pack(self):
+		self.close();
+		self.number += 1;
+		self.name = os.path.join(PACKS_DIR, "pack-%06d" % self.number);
+		# Packs of a resumed backup hold files already copied.
+		metadata = Backup.metadata_path(self.version_path);
+		while os.path.exists(os.path.join(metadata, self.name)):
+			self.number += 1;
+			self.name = os.path.join(PACKS_DIR, "pack-%06d" % self.number);
+		os.makedirs(os.path.join(metadata, PACKS_DIR), exist_ok=True);
+		self.file = open(os.path.join(metadata, self.name), "wb");
+		self.offset = 0;
+
+	def close(self):
+		if self.file is not None:
+			self.file.close();
+			self.file = None;
+
+	@staticmethod
+	def read(version_path, storage):
+		"""Reads the contents of a file from the pack it was appended to."""
+		kind, name, offset, length = storage;
+		with open(os.path.join(Backup.metadata_path(version_path), name), "rb") as f:
+			f.seek(offset);
+			return f.read(length);
+
+class ObjectStore(object):
+	"""A content addressed store of file contents shared by every backup in
+	a destination. Each object is named by the SHA-256 of its contents so
+	the same contents are only stored once.
+	Attributes
+	----------
+	path : str
+		The filepath of the store, inside the destination."""
+
+	def __init__(self, destination):
+		self.path = os.path.join(destination, OBJECT_STORE_NAME);
+
+	def object_path(self, checksum):
+		return os.path.join(self.path, checksum[:2], checksum);
+
+	def put(self, source_file, stats=None):
+		"""Adds the contents of a file to the store if not already there.
+		The contents are hashed first so known contents are never written, new
+		contents are hashed again while copying in case the file changed.
+		stats : Stats
+			Counts the files opened and, beyond the first read of the file
+			counted with every copy, the bytes read and written, if given.
+		Returns : str
+			The checksum the contents are stored under."""
+		checksum = Backup.file_checksum(source_file);
+		if stats is not None:
+			stats.add(open=1);
+		if os.path.exists(self.object_path(checksum)):
+			return checksum;
+		os.makedirs(self.path, exist_ok=True);
+		h = hashlib.sha256();
+		# Source processes share the store, so the temporary name must be unique
+		# across processes and not only threads.
+		fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=self.path);
+		try:
+			size = 0;
+			with open(source_file, "rb") as src, os.fdopen(fd, "wb") as dst:
+				for block in iter(lambda: src.read(1024 * 1024), b""):
+					h.update(block);
+					dst.write(block);
+					size += len(block);
+			if stats is not None:
+				stats.add(open=2, bytes_read=size, bytes_written=size);
+			checksum = h.hexdigest();
+			os.makedirs(os.path.dirname(self.object_path(checksum)), exist_ok=True);
+			os.replace(tmp, self.object_path(checksum));
+		finally:
+			if os.path.exists(tmp):
+				os.remove(tmp);
+		return checksum;
+
+	def open(self, checksum):
+		"""Opens a stored object for reading in binary mode."""
+		return open(self.object_path(checksum), "rb");
 
 # --- Custom Errors ---
 class BackupError(Exception):
@@ -570,10 +3421,67 @@ class NoDestinationError(BackupError):
 	pass
 class NoFilesToBackupError(BackupError):
 	pass
+class NoVersionError(BackupError):
+	pass
 
 
 # --- END CLASS DEFINITIONS ---
 
+def in_background(iterable, size):
+	"""Runs an iterable in a background thread, yielding its items through a
+	queue of at most size items. Errors are raised in the caller. If the
+	caller stops early the thread stops too."""
+	items = queue.Queue(size);
+	stop = threading.Event();
+	done = object();
+	def put(item):
+		while not stop.is_set():
+			try:
+				items.put(item, timeout=0.1);
+				return True;
+			except queue.Full:
+				pass;
+		return False;
+	def produce():
+		try:
+			for item in iterable:
+				if not put((item, None)):
+					return;
+			put((done, None));
+		except BaseException as e:
+			put((done, e));
+	thread = threading.Thread(target=produce, daemon=True);
+	thread.start();
+	try:
+		while True:
+			item, error = items.get();
+			if item is done:
+				if error is not None:
+					raise error;
+				return;
+			yield item;
+	finally:
+		stop.set();
+
+# Shared count of files found per source, set in each source worker process.
+_found_counts = None;
+
+def _init_source_worker(found):
+	global _found_counts;
+	_found_counts = found;
+	Interface.verbose = False;
+
+def _backup_source_worker(backup, src_num):
+	"""Backs up one source in a worker process. Failures are returned in the
+	summary rather than raised so the other sources carry on."""
+	backup.shared_found = _found_counts;
+	try:
+		return backup.backup_source(src_num);
+	except (BackupError, OSError) as e:
+		return {"name": backup.get_backup_name(backup.sources[src_num]), "version": backup.backup_version,
+			"started": None, "found": 0, "files": 0, "bytes": 0, "linked": 0, "linked_bytes": 0, "copy_methods": {},
+			"errors": [], "seconds": 0.0, "failure": str(e) or type(e).__name__, "stats": None};
+
 
 if __name__ == "__main__":
 	Interface().main();
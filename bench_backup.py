@@ -0,0 +1,262 @@
+"""Python Backup Benchmarks
+Times the phases of a backup over generated source trees so runs of different
+commits can be compared.
+
+Copyright (C) 2015  James Benson (jmbensonn@gmail.com)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>."""
+
+import sys;
+import getopt;
+import os;
+import shutil;
+import json;
+import random;
+import tempfile;
+import time;
+import platform;
+import subprocess;
+import concurrent.futures;
+from datetime import datetime;
+try:
+	import resource;
+except ImportError: # Windows
+	resource = None;
+import backup;
+
+BENCH_USAGE = "usage: bench_backup.py [-o output.json] [-s scale] [-j jobs] [--seed n] [--keep] [directory]";
+
+# The generated trees at scale 1. Every file and date modified comes from the
+# seed so each run backs up the same trees.
+SCENARIOS = {
+	# Many tiny files spread over a few directories.
+	"tiny": {"files": 20000, "directories": 100, "depth": 1, "min_size": 0, "max_size": 4096},
+	# Few files in each of a long line of nested directories.
+	"deep": {"files": 5000, "directories": 500, "depth": 50, "min_size": 0, "max_size": 16384},
+	# A few huge files.
+	"huge": {"files": 4, "directories": 1, "depth": 1, "min_size": 64 << 20, "max_size": 64 << 20},
+	# A full backup followed by a chain of increments, each after some of the
+	# files were modified.
+	"chain": {"files": 5000, "directories": 50, "depth": 2, "min_size": 0, "max_size": 8192,
+		"increments": 50, "modified": 0.02},
+};
+
+# The dates modified of the generated files, and of each round of modifications.
+BASE_MTIME = datetime(2015, 8, 1).timestamp();
+
+class Bench(object):
+	"""Generates the source trees and runs each phase of the benchmark.
+	Attributes
+	----------
+	directory : str
+		Where the sources and backups are made.
+	scale : float
+		Multiplies the number of files of each scenario.
+	jobs : int
+		The copying threads.
+	seed : int
+		The seed of the generated trees."""
+
+	def __init__(self, directory, scale=1.0, jobs=1, seed=0):
+		self.directory = directory;
+		self.scale = scale;
+		self.jobs = jobs;
+		self.seed = seed;
+
+	def run(self, scenarios=SCENARIOS):
+		"""Runs every phase of each scenario.
+		Returns : dict
+			The results of the run with the details needed to compare it."""
+		results = [];
+		for name, spec in scenarios.items():
+			random.seed("%s-%s" % (self.seed, name));
+			source = os.path.join(self.directory, "src", name);
+			files = self.make_tree(source, spec);
+			results.append(self.phase(name, "backup_source", bench_backup_source, source,
+				os.path.join(self.directory, "full", name), self.jobs));
+			results.append(self.phase(name, "copying_start", bench_copying_start, source,
+				os.path.join(self.directory, "copy", name), self.jobs));
+			destination = os.path.join(self.directory, "full", name);
+			for i in range(spec.get("increments", 0)):
+				self.modify(source, files, spec, i + 1);
+				increment = backup.Increment();
+				increment.add_source(source);
+				increment.set_destination(destination);
+				increment.backup_source(0);
+			if "increments" in spec:
+				self.modify(source, files, spec, spec["increments"] + 1);
+			results.append(self.phase(name, "increment_decisions", bench_increment_decisions,
+				source, destination));
+		return {"date": datetime.now().isoformat(), "commit": git_commit(), "python": platform.python_version(),
+			"platform": platform.platform(), "scale": self.scale, "jobs": self.jobs, "seed": self.seed,
+			"results": results};
+
+	def phase(self, scenario, name, function, *args):
+		"""Runs a phase in a new process so its peak memory is its own."""
+		with concurrent.futures.ProcessPoolExecutor(1) as executor:
+			result = executor.submit(function, *args).result();
+		result["scenario"] = scenario;
+		result["phase"] = name;
+		seconds = result["seconds"] or 1e-9;
+		result["files_per_s"] = result["files"] / seconds;
+		result["mb_per_s"] = result["bytes"] / seconds / (1 << 20);
+		return result;
+
+	def make_tree(self, top, spec):
+		"""Writes the files of a scenario under top.
+		Returns : [str]
+			The filepaths of the files relative to top."""
+		directories = [];
+		for d in range(max(1, int(spec["directories"] * min(1, self.scale)))):
+			parts = ["d%03d" % d] + ["n%02d" % level for level in range(random.randrange(spec["depth"]))];
+			directories.append(os.path.join(*parts));
+		files = [];
+		for n in range(max(1, int(spec["files"] * self.scale))):
+			rel = os.path.join(directories[n % len(directories)], "f%06d.bin" % n);
+			self.write_file(os.path.join(top, rel), random.randint(spec["min_size"], spec["max_size"]), BASE_MTIME);
+			files.append(rel);
+		return files;
+
+	def modify(self, top, files, spec, round):
+		"""Rewrites some of the files with a later date modified."""
+		for rel in random.sample(files, max(1, int(len(files) * spec["modified"]))):
+			self.write_file(os.path.join(top, rel), random.randint(spec["min_size"], spec["max_size"]),
+				BASE_MTIME + round * 60);
+
+	@staticmethod
+	def write_file(path, size, mtime):
+		os.makedirs(os.path.dirname(path), exist_ok=True);
+		block = random.randbytes(min(size, 1 << 20));
+		with open(path, "wb") as f:
+			written = 0;
+			while written < size:
+				f.write(block[:size - written]);
+				written += len(block);
+		os.utime(path, (mtime, mtime));
+
+# The phases, run in a process of their own.
+
+def peak_rss():
+	"""The peak resident memory of the process in kilobytes, or None when unknown."""
+	if resource is None:
+		return None;
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss;
+	return peak // 1024 if sys.platform == "darwin" else peak;
+
+def bench_backup_source(source, destination, jobs):
+	"""Times a full backup of the source."""
+	os.makedirs(destination, exist_ok=True);
+	full = backup.Full();
+	full.add_source(source);
+	full.set_destination(destination);
+	full.jobs = jobs;
+	started = time.perf_counter();
+	summary = full.backup_source(0);
+	seconds = time.perf_counter() - started;
+	return {"seconds": seconds, "files": summary["found"], "bytes": summary["bytes"],
+		"errors": len(summary["errors"]), "peak_rss_kb": peak_rss()};
+
+def bench_copying_start(source, destination, jobs):
+	"""Times copying every file of the source, found beforehand."""
+	copy = backup.Copying(jobs);
+	size = 0;
+	for relpath, files in backup.Backup.walk(source):
+		for name, st in files:
+			copy.add(os.path.join(source, relpath, name), os.path.join(destination, relpath), st);
+			size += st.st_size;
+	started = time.perf_counter();
+	copy.start();
+	seconds = time.perf_counter() - started;
+	return {"seconds": seconds, "files": copy.count, "bytes": size,
+		"errors": len(copy.errors), "peak_rss_kb": peak_rss()};
+
+def bench_increment_decisions(source, destination):
+	"""Times deciding which files of the source an increment copies, without
+	walking or copying. Loading the chain of backups is timed on its own."""
+	found = [(os.path.join(relpath, name), st) for relpath, files in backup.Backup.walk(source)
+		for name, st in files];
+	increment = backup.Increment();
+	increment.add_source(source);
+	increment.set_destination(destination);
+	started = time.perf_counter();
+	increment.backup_init(0);
+	chain_seconds = time.perf_counter() - started;
+	started = time.perf_counter();
+	for rel, st in found:
+		increment.backup_file(rel, st);
+	increment.files_done();
+	seconds = time.perf_counter() - started;
+	return {"seconds": seconds, "files": len(found), "bytes": sum(st.st_size for rel, st in found),
+		"chain": len(increment.all_backups), "load_chain_seconds": chain_seconds,
+		"modified": increment.c_modified, "peak_rss_kb": peak_rss()};
+
+def git_commit():
+	"""The commit being benchmarked, if run from a git checkout."""
+	try:
+		return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+			cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip();
+	except (OSError, subprocess.CalledProcessError):
+		return None;
+
+def main():
+	try:
+		options, args = getopt.getopt(sys.argv[1:], "o:s:j:", ["output=", "scale=", "jobs=", "seed=", "keep"]);
+	except getopt.GetoptError as e:
+		sys.exit("%s\n%s" % (e, BENCH_USAGE));
+	output = "bench_backup.json";
+	scale = 1.0;
+	jobs = 1;
+	seed = 0;
+	keep = False;
+	for o, v in options:
+		if o in ("-o", "--output"):
+			output = v;
+		if o in ("-s", "--scale"):
+			scale = float(v);
+		if o in ("-j", "--jobs"):
+			jobs = int(v);
+		if o == "--seed":
+			seed = int(v);
+		if o == "--keep":
+			keep = True;
+	if len(args) > 1:
+		sys.exit(BENCH_USAGE);
+	made = not args;
+	directory = args[0] if args else tempfile.mkdtemp(prefix="bench_backup_");
+	# Only what the bench makes is removed, never the rest of a directory given.
+	made_dirs = [os.path.join(directory, d) for d in ("src", "full", "copy")];
+	if any(os.path.exists(d) for d in made_dirs):
+		sys.exit("Already benchmarked in %s" % directory);
+	try:
+		run = Bench(directory, scale, jobs, seed).run();
+	finally:
+		if not keep:
+			for d in made_dirs:
+				shutil.rmtree(d, ignore_errors=True);
+			if made:
+				shutil.rmtree(directory, ignore_errors=True);
+	for r in run["results"]:
+		print("%-6s %-20s %8.3fs %10.0f files/s %8.1f MB/s %8s KB" % (r["scenario"], r["phase"],
+			r["seconds"], r["files_per_s"], r["mb_per_s"], r["peak_rss_kb"]));
+	# Each run is added to the output so the runs of different commits can be compared.
+	runs = [];
+	if os.path.exists(output):
+		with open(output) as f:
+			runs = json.load(f);
+	runs.append(run);
+	with open(output, "w") as f:
+		json.dump(runs, f, indent=1);
+
+if __name__ == "__main__":
+	main();
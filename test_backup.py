@@ -17,9 +17,14 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>."""
 
 import unittest;
+from unittest import mock;
 import backup;
+import sys;
 import os;
 import shutil;
+import time;
+import threading;
+import json;
 from datetime import datetime;
 
 class BackupTestCase(unittest.TestCase):
@@ -145,6 +150,48 @@ class BackupTestCase(unittest.TestCase):
 		# self.set_file_mtime(self.file004, 2014, 12, 12, 10, 0, 0);
 		# self.set_file_mtime(self.file005, 2014, 10, 9, 20, 20, 0);
 
+class WalkTestCase(BackupTestCase):
+	def setUp(self):
+		self.set_up_sources();
+
+	def tearDown(self):
+		self.destroy_sources();
+
+	def test_walk(self):
+		walked = dict(backup.Backup.walk(self.src1));
+		self.assertEqual(sorted(walked), ["", "sub1", os.path.join("sub1", "sub1_1"),
+			os.path.join("sub1", "sub1_2"), "sub2"]);
+		self.assertEqual(sorted(name for name, st in walked[os.path.join("sub1", "sub1_2")]),
+			["file004.txt", "file005.txt"]);
+		name, st = walked[os.path.join("sub1", "sub1_1")][0];
+		self.assertEqual(st.st_mtime, os.path.getmtime(self.file003));
+		self.assertEqual(walked["sub2"], []);
+
+	def test_filter(self):
+		modules = os.path.join(self.src1_sub1, "node_modules", "lib");
+		self.make_dirs(modules);
+		self.make_sample_file(os.path.join(modules, "index.js"), "");
+		self.make_sample_file(os.path.join(self.src1_sub2, "main.o"), "");
+		walk_filter = backup.Filter(excludes=["node_modules/", "*.o", "sub1/sub1_2/file004.txt"]);
+		stats = backup.Stats();
+		walked = dict(backup.Backup.walk(self.src1, stats, walk_filter));
+		self.assertNotIn(os.path.join("sub1", "node_modules"), walked, "Excluded directories should not be walked.");
+		self.assertEqual(stats.counts["listdir"], 5);
+		self.assertEqual(walked["sub2"], []);
+		self.assertEqual([name for name, st in walked[os.path.join("sub1", "sub1_2")]], ["file005.txt"]);
+
+		walk_filter = backup.Filter(includes=["file00[13].txt"], excludes=["sub1_1/"]);
+		files = [os.path.join(rel, name) for rel, names in backup.Backup.walk(self.src1, None, walk_filter)
+			for name, st in names];
+		self.assertEqual(files, [self.file001relpath]);
+
+		# Including a directory includes the files under it.
+		walk_filter = backup.Filter(includes=["sub1_2/"]);
+		files = sorted(os.path.join(rel, name) for rel, names in backup.Backup.walk(self.src1, None, walk_filter)
+			for name, st in names);
+		self.assertEqual(files, [self.file004relpath, self.file005relpath]);
+		self.assertFalse(backup.Filter(includes=["docs/"]).wants_file("src/main.c"));
+
 class SourcesTestCase(BackupTestCase):
 	def setUp(self):
 		self.set_up_sources();
@@ -251,6 +298,38 @@ class BackupsTestCase(BackupTestCase):
 		self.assertRaises(TypeError, self.backup.get_backup_name, 9);
 
 
+	def test_inBackground(self):
+		self.assertEqual(list(backup.in_background(range(100), 4)), list(range(100)));
+		def failing():
+			yield 1;
+			raise OSError("walk failed");
+		items = backup.in_background(failing(), 4);
+		self.assertEqual(next(items), 1);
+		self.assertRaises(OSError, next, items);
+		# Stopping early leaves the producer free to finish.
+		items = backup.in_background(iter(range(1000)), 2);
+		self.assertEqual(next(items), 0);
+		items.close();
+
+	def test_progress(self):
+		shown = [];
+		def line():
+			shown.append(time.time());
+			return "";
+		# Nothing is shown when not printing.
+		progress = backup.Progress(line);
+		self.assertIsNone(progress.thread);
+		progress.stop();
+		self.assertEqual(shown, []);
+		# The line is drawn on the timer, not for each change of the counters.
+		progress.tty = True;
+		progress.thread = threading.Thread(target=progress.show, daemon=True);
+		progress.thread.start();
+		time.sleep(backup.PROGRESS_INTERVAL * 4.5);
+		progress.stop();
+		self.assertTrue(3 <= len(shown) <= 6, len(shown));
+		self.assertIsNone(progress.thread);
+
 class LocalBackupsTestCase(BackupTestCase):
 	"""Test the methods that handle the backups."""
 	def setUp(self):
@@ -318,6 +397,22 @@ class LocalBackupsTestCase(BackupTestCase):
 		self.assertEqual(self.backup.get_increments_for(self.bup3, 1),
 		[], "Dir does not exist: Should not be any increments for 1, 2 does not exist"); # should this error?
 
+	def test_catalog(self):
+		backup.Catalog.update(self.bup1);
+		self.assertTrue(os.path.isfile(os.path.join(self.bup1, backup.CATALOG_NAME)));
+		backup.Catalog.cache.clear();
+		# Read from the catalog without listing the directory.
+		with mock.patch.object(backup.Catalog, "scan", side_effect=AssertionError("listed")):
+			self.assertEqual(self.backup.get_increments_for(self.bup1, 2),
+				[(1, self.bup1_f2_i1), (2, self.bup1_f2_i2)]);
+			self.assertEqual(len(self.backup.get_all_full_backups(self.bup1)), 4);
+		# A new version changes the directory so it is listed again.
+		bup1_f5 = os.path.join(self.bup1, "2015-07-05_2300__Full-5");
+		self.make_dirs(bup1_f5);
+		self.assertEqual(self.backup.get_last_full_backup(self.bup1), (5, bup1_f5));
+		self.assertEqual(backup.Backup.full_version("2015-07-05_2300__Full-5"), 5);
+		self.assertIsNone(backup.Backup.full_version("2015-07-05_2300__Full-5.tmp"));
+
 class BackupExecutionTestCase(BackupTestCase):
 	def setUp(self):
 		self.set_up_sources();
@@ -424,5 +519,719 @@ class BackupExecutionTestCase(BackupTestCase):
 		self.assertFalse(os.path.isfile(os.path.join(self.increment.backup_path, self.file005relpath)),
 		"File005 should not have been backed up.");
 
+	def test_manifest(self):
+		self.full.add_source(self.src1);
+		self.full.set_destination(self.test_bup_dir);
+		self.increment.add_source(self.src1);
+		self.increment.set_destination(self.test_bup_dir);
+
+		self.full.backup_source(0);
+		manifest = backup.FileIndex.load(self.full.backup_path);
+		self.assertEqual(len(manifest), 5, "All 5 files should be in the manifest.");
+		self.assertEqual(manifest.get(self.file003relpath).mtime, os.path.getmtime(self.file003));
+		self.assertEqual(manifest.get(self.file003relpath).location, self.full.backup_path);
+		self.assertEqual(manifest.get("missing.txt"), None);
+
+		# Versions made before the metadata directory have the manifest at their root.
+		metadata = backup.Backup.metadata_path(self.full.backup_path);
+		os.rename(os.path.join(metadata, backup.MANIFEST_NAME),
+			os.path.join(self.full.backup_path, backup.LEGACY_MANIFEST_NAME));
+		shutil.rmtree(metadata);
+		self.assertEqual(len(backup.FileIndex.load(self.full.backup_path)), 5);
+
+		self.set_file_mtime(self.file004, 2015, 1, 1, 0, 0, 0);
+		self.increment.backup_source(0);
+		self.assertNotEqual(self.increment.chain, None, "Increment should use the manifests.");
+		self.assertEqual(len(self.increment.copy.copylist), 1, "Only file004 should be copied.");
+		manifest = backup.FileIndex.load(self.increment.backup_path);
+		self.assertEqual([rel for rel, e in manifest.items()], [self.file004relpath]);
+
+		# The chain now holds the newest copy of file004.
+		self.increment.backup_source(0);
+		self.assertEqual(len(self.increment.copy.copylist), 0, "No files should be copied.");
+
+	def test_sourceMetadataNames(self):
+		# Files in a source with the names of version metadata are backed up like any other.
+		self.make_sample_file(os.path.join(self.src1, ".manifest"), "# backup manifest 1\n[\"x\"]\n");
+		self.make_sample_file(os.path.join(self.src1, ".journal"), "Journal");
+		self.make_dirs(os.path.join(self.src1, ".packs"));
+		self.make_sample_file(os.path.join(self.src1, ".packs", "pack-000001"), "Pack");
+		self.full.add_source(self.src1);
+		self.full.set_destination(self.test_bup_dir);
+		self.full.pack_threshold = 4;
+		self.full.backup_source(0);
+		self.assertEqual(len(backup.FileIndex.load(self.full.backup_path)), 8);
+		self.increment.add_source(self.src1);
+		self.increment.set_destination(self.test_bup_dir);
+		self.increment.backup_source(0);
+		self.assertEqual(len(self.increment.chain), 8);
+		self.assertEqual(len(self.increment.copy.copylist), 0, "No files should be copied.");
+
+		restore = backup.Restore(self.test_bup_dir, "source_one");
+		target = os.path.join(self.test_bup_dir, "Restored");
+		restore.restore(restore.find_chain(), target);
+		with open(os.path.join(target, ".manifest")) as f:
+			self.assertEqual(f.read(), "# backup manifest 1\n[\"x\"]\n");
+		with open(os.path.join(target, ".packs", "pack-000001")) as f:
+			self.assertEqual(f.read(), "Pack");
+
+	def test_chainWithoutManifests(self):
+		self.full.add_source(self.src1);
+		self.full.set_destination(self.test_bup_dir);
+		self.increment.add_source(self.src1);
+		self.increment.set_destination(self.test_bup_dir);
+		self.full.backup_source(0);
+		self.set_file_mtime(self.file002, 2015, 5, 1, 0, 0, 0);
+		self.increment.backup_source(0);
+		first_increment = self.increment.backup_path;
+		# Backups made before manifests were written.
+		shutil.rmtree(backup.Backup.metadata_path(self.full.backup_path));
+		shutil.rmtree(backup.Backup.metadata_path(first_increment));
+
+		self.set_file_mtime(self.file005, 2015, 5, 1, 0, 0, 0);
+		self.increment.backup_source(0);
+		self.assertEqual(len(self.increment.chain), 5, "Chain should hold each file once.");
+		self.assertEqual(self.increment.chain.get(self.file002relpath).location, first_increment,
+			"Newest copy of file002 is in the first increment.");
+		self.assertEqual(self.increment.chain.get(self.file001relpath).location, self.full.backup_path);
+		self.assertEqual(len(self.increment.copy.copylist), 1, "Only file005 should be copied.");
+
+	def test_concurrentCopy(self):
+		self.full.add_source(self.src1);
+		self.full.set_destination(self.test_bup_dir);
+		self.full.jobs = 4;
+		self.full.backup_source(0);
+		self.assertEqual(self.full.copy.workers, 4);
+		for relpath in [self.file001relpath, self.file002relpath, self.file003relpath,
+			self.file004relpath, self.file005relpath]:
+			copied = os.path.join(self.full.backup_path, relpath);
+			self.assertTrue(os.path.isfile(copied), "%s should have been backed up." % relpath);
+			self.assertEqual(os.path.getmtime(copied),
+				os.path.getmtime(os.path.join(self.src1, relpath)));
+
+		# Errors are reported in the order the files were added.
+		copy = backup.Copying(4);
+		missing = [os.path.join(self.src1, "missing%d.txt" % i) for i in range(20)];
+		for m in missing:
+			copy.add(m, self.full.backup_path);
+		copy.start();
+		self.assertEqual(copy.failed, missing);
+		self.assertEqual(copy.errors[0], "Not Found: %s" % missing[0]);
+
+	def test_copyList(self):
+		copylist = backup.CopyList(memory_limit=100);
+		st = os.stat(self.file001);
+		base = (self.test_bup_dir, "sub1/file009.txt", backup.FileEntry(9, 1.5, 0o100644, None, None, self.test_bup_dir));
+		copies = [(os.path.join(self.src1, "sub%d" % (i % 3), "file%03d.txt" % i),
+			os.path.join(self.test_bup_dir, "sub%d" % (i % 3)), st if i in (7, 40) else None,
+			base if i == 9 else None) for i in range(50)];
+		copylist.extend(copies);
+		self.assertEqual(len(copylist), 50);
+		self.assertTrue(copylist.chunks, "The copylist should have been written out.");
+		self.assertEqual(len(copylist.paths), 6, "Each directory should be held once.");
+		snapshot = copylist.snapshot();
+		copylist.append((self.file001, self.test_bup_dir, None, None));
+		got = list(snapshot);
+		self.assertEqual(got, copies, "A snapshot should hold the files added before it.");
+		self.assertEqual((got[7][2].st_mtime, got[7][2].st_mtime_ns), (st.st_mtime, st.st_mtime_ns));
+		self.assertEqual(len(list(copylist)), 51);
+
+	def test_parallelSources(self):
+		self.make_sample_file(os.path.join(self.src2, "file101.txt"), "File 101");
+		self.full.add_source(self.src1);
+		self.full.add_source(self.src2);
+		self.full.set_destination(self.test_bup_dir);
+		self.full.processes = 2;
+		summaries = self.full.backup();
+		self.assertEqual([s["name"] for s in summaries], ["source_one", "source_two"]);
+		self.assertEqual([s["files"] for s in summaries], [5, 1]);
+		self.assertEqual(summaries[1]["bytes"], len("File 101"));
+		self.assertEqual(summaries[0]["failure"], None);
+		self.assertTrue(os.path.isfile(os.path.join(self.test_bup_dir, "source_two",
+			summaries[1]["version"], "file101.txt")), "file101 should have been backed up.");
+
+		# A source that cannot be backed up does not stop the others.
+		self.increment.add_source(self.src1);
+		self.increment.add_source(self.src2);
+		self.increment.set_destination(self.test_bup_dir);
+		self.increment.processes = 2;
+		shutil.rmtree(os.path.join(self.test_bup_dir, "source_one"));
+		summaries = self.increment.backup();
+		self.assertEqual(summaries[0]["failure"], "NoFullBackupError");
+		self.assertEqual(summaries[1]["failure"], None);
+
+	def test_dedup(self):
+		self.make_sample_file(os.path.join(self.src1_sub2, "copy001.txt"), "File 001");
+		self.full.add_source(self.src1);
+		self.full.set_destination(self.test_bup_dir);
+		self.full.dedup = True;
+		counts = self.full.backup_source(0)["stats"]["counts"];
+		# Each file is hashed, and read again and written when it is new.
+		self.assertEqual((counts["open"], counts["bytes_read"], counts["bytes_written"]), (16, 88, 40));
+		store = backup.ObjectStore(self.test_bup_dir);
+		objects = [f for d, dn, fn in os.walk(store.path) for f in fn];
+		self.assertEqual(len(objects), 5, "Files with the same contents should be stored once.");
+		self.assertFalse([f for f in objects if f.endswith(".tmp")], "Temporary files should be renamed or removed.");
+		self.assertFalse(os.path.exists(os.path.join(self.full.backup_path, self.file001relpath)),
+			"Files should not be copied into the version.");
+
+		manifest = backup.FileIndex.load(self.full.backup_path);
+		entry = manifest.get(self.file003relpath);
+		self.assertEqual(entry.storage, [backup.STORAGE_OBJECT]);
+		self.assertEqual(entry.checksum, backup.Backup.file_checksum(self.file003));
+		target = os.path.join(self.test_bup_dir, "restored.txt");
+		backup.Backup.copy_out(self.test_bup_dir, self.file003relpath, entry, target);
+		with open(target) as f:
+			self.assertEqual(f.read(), "File 003");
+		self.assertEqual(os.path.getmtime(target), os.path.getmtime(self.file003));
+
+		# A second full stores nothing new.
+		self.full.backup_source(0);
+		self.assertEqual(len([f for d, dn, fn in os.walk(store.path) for f in fn]), 5);
+		self.assertEqual(len(backup.FileIndex.load(self.full.backup_path)), 6);
+
+	def test_linkDest(self):
+		self.full.add_source(self.src1);
+		self.full.set_destination(self.test_bup_dir);
+		self.full.link_dest = True;
+		summary = self.full.backup_source(0);
+		self.assertEqual((summary["files"], summary["linked"]), (5, 0));
+		first_full = self.full.backup_path;
+
+		self.set_file_mtime(self.file002, 2015, 5, 1, 0, 0, 0);
+		summary = self.full.backup_source(0);
+		self.assertEqual((summary["files"], summary["linked"]), (1, 4));
+		self.assertEqual((summary["bytes"], summary["linked_bytes"]), (8, 32));
+		self.assertTrue(os.path.samefile(os.path.join(first_full, self.file003relpath),
+			os.path.join(self.full.backup_path, self.file003relpath)),
+			"Unchanged file003 should be a hard link to the previous full.");
+		self.assertFalse(os.path.samefile(os.path.join(first_full, self.file002relpath),
+			os.path.join(self.full.backup_path, self.file002relpath)),
+			"Modified file002 should be copied.");
+		self.assertEqual(len(backup.FileIndex.load(self.full.backup_path)), 5);
+
+	def test_streamingCopy(self):
+		copy = backup.Copying(2);
+		copy.begin();
+		target = os.path.join(self.test_bup_dir, "streamed");
+		copy.add(self.file001, target);
+		copy.add(self.file002, target);
+		copy.finish();
+		self.assertEqual(copy.count, 2);
+		self.assertEqual(sorted(os.listdir(target)), ["file001.txt", "file002.txt"]);
+
+	def test_hashChanges(self):
+		self.full.add_source(self.src1);
+		self.full.set_destination(self.test_bup_dir);
+		self.full.hash_changes = True;
+		self.increment.add_source(self.src1);
+		self.increment.set_destination(self.test_bup_dir);
+		self.increment.hash_changes = True;
+		self.increment.jobs = 2;
+		self.full.backup_source(0);
+		cache = backup.HashCache(os.path.join(self.test_bup_dir, "source_one"));
+		self.assertEqual(cache.get(self.file001relpath, os.stat(self.file001)),
+			backup.Backup.file_checksum(self.file001), "Full should fill the hash cache.");
+
+		# Touched but unchanged files are not copied.
+		self.set_file_mtime(self.file001, 2015, 8, 1, 0, 0, 0);
+		# Changed contents with the date modified kept are copied.
+		self.make_sample_file(self.file002, "File 00X");
+		self.set_file_mtime(self.file002, 2015, 4, 24, 17, 30, 0);
+		summary = self.increment.backup_source(0);
+		self.assertEqual([c[0] for c in self.increment.copy.copylist], [self.file002]);
+		self.assertEqual((self.increment.c_modified, self.increment.c_unmodified), (1, 4));
+		self.assertEqual(summary["stats"]["counts"]["bytes_read"], 24, "Both files hashed and file002 copied.");
+		cache = backup.HashCache(os.path.join(self.test_bup_dir, "source_one"));
+		self.assertEqual(cache.get(self.file002relpath, os.stat(self.file002)),
+			backup.Backup.file_checksum(self.file002));
+
+	def test_deltaIncrement(self):
+		block_size = backup.DELTA_BLOCK_SIZE;
+		backup.DELTA_BLOCK_SIZE = 4;
+		try:
+			image = self.make_sample_file(os.path.join(self.src1, "image.bin"), "aaaabbbbccccdddd");
+			self.set_file_mtime(image, 2015, 1, 1, 0, 0, 0);
+			# Files named like the delta of another are kept apart from it.
+			others = [self.make_sample_file(os.path.join(self.src1, "image.bin" + suffix), "Other")
+				for suffix in (".delta", ".blocks")];
+			for other in others:
+				self.set_file_mtime(other, 2015, 1, 1, 0, 0, 0);
+			self.full.add_source(self.src1);
+			self.full.set_destination(self.test_bup_dir);
+			self.increment.add_source(self.src1);
+			self.increment.set_destination(self.test_bup_dir);
+			self.increment.delta_threshold = 10;
+			self.full.backup_source(0);
+
+			self.make_sample_file(image, "aaaaBBBBccccdddd");
+			for other in others:
+				self.make_sample_file(other, "Otter");
+			summary = self.increment.backup_source(0);
+			self.assertEqual(summary["stats"]["counts"]["bytes_read"], 16 + 16 + 10, "The base is read too.");
+			stored = os.path.join(self.increment.backup_path, "image.bin");
+			self.assertFalse(os.path.exists(stored), "Only the delta should be stored.");
+			delta_path, blocks_path = backup.Delta.paths(self.increment.backup_path, "image.bin");
+			with open(delta_path) as f:
+				self.assertEqual(f.read(), "BBBB");
+			manifest = backup.FileIndex.load(self.increment.backup_path);
+			entry = manifest.get("image.bin");
+			self.assertEqual(entry.storage, [backup.STORAGE_DELTA, os.path.basename(self.full.backup_path)]);
+			for other in others:
+				with open(os.path.join(self.increment.backup_path, os.path.basename(other))) as f:
+					self.assertEqual(f.read(), "Otter");
+				self.assertEqual(manifest.get(os.path.basename(other)).storage, None);
+
+			# A delta against a delta, with the file cut short.
+			self.make_sample_file(image, "aaaaBBBBccCC");
+			self.set_file_mtime(image, 2030, 1, 1, 0, 0, 0);
+			self.increment.backup_source(0);
+			with open(backup.Delta.paths(self.increment.backup_path, "image.bin")[0]) as f:
+				self.assertEqual(f.read(), "ccCC");
+			entry = backup.FileIndex.load(self.increment.backup_path).get("image.bin");
+			target = os.path.join(self.test_bup_dir, "restored.bin");
+			backup.Backup.copy_out(self.test_bup_dir, "image.bin", entry, target);
+			with open(target) as f:
+				self.assertEqual(f.read(), "aaaaBBBBccCC");
+			self.assertEqual(os.path.getmtime(target), os.path.getmtime(image));
+
+			# Verify reads the delta and its bases without rebuilding the file.
+			verify = backup.Verify(self.test_bup_dir, "source_one");
+			with mock.patch.object(backup.tempfile, "mkstemp", side_effect=AssertionError):
+				self.assertEqual(verify.stored_checksum("image.bin", entry), (backup.Backup.file_checksum(target), 12));
+		finally:
+			backup.DELTA_BLOCK_SIZE = block_size;
+
+	def test_deltaBase(self):
+		block_size = backup.DELTA_BLOCK_SIZE;
+		backup.DELTA_BLOCK_SIZE = 4;
+		try:
+			image = self.make_sample_file(os.path.join(self.src1, "image.bin"), "aaaabbbbccccdddd");
+			self.set_file_mtime(image, 2015, 1, 1, 0, 0, 0);
+			self.full.add_source(self.src1);
+			self.full.set_destination(self.test_bup_dir);
+			self.increment.add_source(self.src1);
+			self.increment.set_destination(self.test_bup_dir);
+			self.increment.delta_threshold = 10;
+			self.full.backup_source(0);
+			# A full backup made before manifests.
+			os.remove(os.path.join(backup.Backup.metadata_path(self.full.backup_path), backup.MANIFEST_NAME));
+
+			self.make_sample_file(image, "aaaaBBBBccccdddd");
+			self.increment.backup_source(0);
+			restore = backup.Restore(self.test_bup_dir, "source_one");
+			target = os.path.join(self.test_bup_dir, "Restored");
+			restore.restore(restore.find_chain(), target);
+			self.assertEqual(restore.errors, []);
+			with open(os.path.join(target, "image.bin")) as f:
+				self.assertEqual(f.read(), "aaaaBBBBccccdddd");
+
+			# A base that cannot be read is not used, the file is copied whole.
+			os.remove(backup.Delta.paths(self.increment.backup_path, "image.bin")[1]);
+			self.make_sample_file(image, "aaaaBBBBCCCCdddd");
+			self.set_file_mtime(image, 2030, 1, 1, 0, 0, 0);
+			self.increment.backup_source(0);
+			self.assertEqual(self.increment.copy.errors, []);
+			with open(os.path.join(self.increment.backup_path, "image.bin")) as f:
+				self.assertEqual(f.read(), "aaaaBBBBCCCCdddd");
+		finally:
+			backup.DELTA_BLOCK_SIZE = block_size;
+
+	def test_compression(self):
+		photo = self.make_sample_file(os.path.join(self.src1, "photo.jpg"), "not really a jpeg");
+		self.full.add_source(self.src1);
+		self.full.set_destination(self.test_bup_dir);
+		self.full.compression = "xz";
+		self.full.jobs = 2;
+		self.full.backup_source(0);
+		stored = os.path.join(self.full.backup_path, self.file003relpath);
+		with open(stored, "rb") as f:
+			self.assertNotEqual(f.read(), b"File 003", "file003 should be compressed.");
+		self.assertEqual(os.path.getmtime(stored), os.path.getmtime(self.file003));
+		self.assertTrue(os.path.isfile(os.path.join(self.full.backup_path, "photo.jpg")),
+			"Already compressed files should be copied as they are.");
+
+		manifest = backup.FileIndex.load(self.full.backup_path);
+		entry = manifest.get(self.file003relpath);
+		self.assertEqual(entry.storage, [backup.STORAGE_COMPRESSED, "xz"]);
+		self.assertEqual(manifest.get("photo.jpg").storage, None);
+		with backup.Backup.open_stored(self.test_bup_dir, self.file003relpath, entry) as f:
+			self.assertEqual(f.read(), b"File 003");
+
+		# Increments compare with the manifest, not the compressed copies.
+		self.increment.add_source(self.src1);
+		self.increment.set_destination(self.test_bup_dir);
+		self.increment.backup_source(0);
+		self.assertEqual(len(self.increment.copy.copylist), 0, "No files should be copied.");
+
+	def test_compressionNames(self):
+		# A.tar is compressed and a.tar.gz is copied as it is, both under their own names.
+		self.make_sample_file(os.path.join(self.src1, "a.tar"), "Tar");
+		self.make_sample_file(os.path.join(self.src1, "a.tar.gz"), "Not really gzip");
+		self.full.add_source(self.src1);
+		self.full.set_destination(self.test_bup_dir);
+		self.full.compression = "gz";
+		self.full.backup_source(0);
+		manifest = backup.FileIndex.load(self.full.backup_path);
+		self.assertEqual(manifest.get("a.tar").storage, [backup.STORAGE_COMPRESSED, "gz"]);
+		self.assertEqual(manifest.get("a.tar.gz").storage, None);
+
+		restore = backup.Restore(self.test_bup_dir, "source_one");
+		target = os.path.join(self.test_bup_dir, "Restored");
+		restore.restore(restore.find_chain(), target);
+		self.assertEqual(restore.errors, []);
+		with open(os.path.join(target, "a.tar")) as f:
+			self.assertEqual(f.read(), "Tar");
+		with open(os.path.join(target, "a.tar.gz")) as f:
+			self.assertEqual(f.read(), "Not really gzip");
+
+	def test_packs(self):
+		large = self.make_sample_file(os.path.join(self.src1_sub2, "large.txt"), "x" * 100);
+		self.full.add_source(self.src1);
+		self.full.set_destination(self.test_bup_dir);
+		self.full.pack_threshold = 50;
+		self.full.jobs = 3;
+		self.full.backup_source(0);
+		self.assertFalse(os.path.exists(os.path.join(self.full.backup_path, self.file003relpath)),
+			"Small files should be packed.");
+		self.assertFalse(os.path.exists(os.path.join(self.full.backup_path, "sub1")),
+			"No directories should be made for packed files.");
+		self.assertTrue(os.path.isfile(os.path.join(self.full.backup_path, "sub2", "large.txt")),
+			"Large files should be copied.");
+		pack = os.path.join(backup.Backup.metadata_path(self.full.backup_path), backup.PACKS_DIR, "pack-000001");
+		self.assertEqual(os.path.getsize(pack), 5 * len("File 001"));
+
+		manifest = backup.FileIndex.load(self.full.backup_path);
+		for relpath, contents in [(self.file001relpath, b"File 001"), (self.file004relpath, b"File 004"),
+			(os.path.join("sub2", "large.txt"), b"x" * 100)]:
+			with backup.Backup.open_stored(self.test_bup_dir, relpath, manifest.get(relpath)) as f:
+				self.assertEqual(f.read(), contents);
+		self.assertEqual(manifest.get(self.file004relpath).storage[0], backup.STORAGE_PACK);
+
+	def test_copyKernel(self):
+		self.make_sample_file(os.path.join(self.src1, "big.txt"), "0123456789" * 1000);
+		self.full.add_source(self.src1);
+		self.full.set_destination(self.test_bup_dir);
+		self.full.buffer_size = 64;
+		summary = self.full.backup_source(0);
+		self.assertEqual(sum(summary["copy_methods"].values()), 10040);
+		with open(os.path.join(self.full.backup_path, "big.txt")) as f:
+			self.assertEqual(f.read(), "0123456789" * 1000);
+
+		# Each method copies the whole file, falling back when unsupported.
+		target = os.path.join(self.test_bup_dir, "kernel.txt");
+		for method in backup.CopyKernel.METHODS:
+			kernel = backup.CopyKernel(7);
+			def unsupported(*args):
+				raise OSError(backup.errno.EXDEV, "unsupported");
+			for skipped in backup.CopyKernel.METHODS[:backup.CopyKernel.METHODS.index(method)]:
+				setattr(kernel, skipped, unsupported);
+			with open(self.file003, "rb") as src, open(target, "wb") as dst:
+				kernel.copy(src, dst, os.stat(self.file003));
+			with open(target) as f:
+				self.assertEqual(f.read(), "File 003", "%s should copy the file." % method);
+			if method != "reflink":
+				self.assertEqual(list(kernel.bytes.values()), [8]);
+
+		# A method that copies nothing of a file with contents falls back too.
+		kernel = backup.CopyKernel(7);
+		kernel.reflink = lambda *args: None;
+		with mock.patch.object(backup.os, "copy_file_range", lambda *args: 0, create=True), \
+				mock.patch.object(backup.os, "sendfile", lambda *args: 0, create=True):
+			with open(self.file003, "rb") as src, open(target, "wb") as dst:
+				kernel.copy(src, dst, os.stat(self.file003));
+		with open(target) as f:
+			self.assertEqual(f.read(), "File 003");
+		self.assertEqual(kernel.bytes, {"buffered": 8});
+
+	def test_manifestChecksum(self):
+		self.full.add_source(self.src1);
+		self.full.set_destination(self.test_bup_dir);
+		self.full.checksums = True;
+		self.full.backup_source(0);
+		manifest = backup.FileIndex.load(self.full.backup_path);
+		self.assertEqual(manifest.get(self.file001relpath).checksum,
+			backup.Backup.file_checksum(self.file001));
+
+	def test_report(self):
+		# A file named like the report in the source does not take its place.
+		self.make_sample_file(os.path.join(self.src1, ".report"), '{"started": 0}');
+		self.full.add_source(self.src1);
+		self.full.set_destination(self.test_bup_dir);
+		self.full.report_path = os.path.join(self.test_bup_dir, "run.json");
+		summary, = self.full.backup();
+		stats = summary["stats"];
+		self.assertEqual(stats["counts"]["listdir"], 5);
+		self.assertEqual(stats["counts"]["stat"], 6);
+		self.assertEqual(stats["counts"]["bytes_read"], 54);
+		self.assertEqual(stats["counts"]["bytes_written"], 54);
+		for phase in ("discovery", "walk", "decide", "copy", "copy_wait", "manifest"):
+			self.assertIn(phase, stats["phases"]);
+		self.assertEqual(len(stats["slowest"]), 6);
+		with open(os.path.join(backup.Backup.metadata_path(self.full.backup_path), backup.REPORT_NAME)) as f:
+			self.assertEqual(json.load(f)["stats"]["counts"], stats["counts"]);
+		with open(self.full.report_path) as f:
+			run = json.load(f);
+		self.assertEqual(run["type"], "Full");
+		self.assertIn("peak_memory_kb", run);
+		self.assertEqual(run["sources"][0]["stats"]["counts"], stats["counts"]);
+		# The version holds only the backed up files.
+		index = backup.FileIndex();
+		index.read_tree(self.full.backup_path);
+		self.assertEqual(len(index), 6);
+		with open(os.path.join(self.full.backup_path, ".report")) as f:
+			self.assertEqual(f.read(), '{"started": 0}');
+		self.assertEqual(backup.Increment.started(self.full.backup_path), summary["started"]);
+
+	def test_resume(self):
+		self.full.add_source(self.src1);
+		self.full.set_destination(self.test_bup_dir);
+		self.full.backup_source(0);
+		version_path = self.full.backup_path;
+		self.assertFalse(os.path.exists(os.path.join(backup.Backup.metadata_path(version_path), backup.JOURNAL_NAME)),
+			"The journal should be removed once the manifest is written.");
+		# Interrupted after copying file001 and file002, while copying file003.
+		manifest = backup.FileIndex.load(version_path);
+		os.remove(os.path.join(backup.Backup.metadata_path(version_path), backup.MANIFEST_NAME));
+		journal = backup.Journal(version_path);
+		journal.add(self.file001relpath, manifest.get(self.file001relpath));
+		journal.add(self.file002relpath, manifest.get(self.file002relpath));
+		journal.file.close();
+		with open(journal.filepath, "a") as f:
+			f.write('["sub1');
+		self.make_sample_file(os.path.join(version_path, self.file001relpath), "Kept 001");
+		self.make_sample_file(os.path.join(version_path, self.file003relpath), "File");
+
+		resumed = backup.Full();
+		resumed.add_source(self.src1);
+		resumed.set_destination(self.test_bup_dir);
+		resumed.resume = True;
+		summary = resumed.backup_source(0);
+		self.assertEqual(resumed.backup_path, version_path);
+		self.assertEqual(summary["stats"]["counts"]["resumed"], 2);
+		self.assertEqual(len(backup.FileIndex.load(version_path)), 5);
+		self.assertFalse(os.path.exists(os.path.join(backup.Backup.metadata_path(version_path), backup.JOURNAL_NAME)));
+		with open(os.path.join(version_path, self.file001relpath)) as f:
+			self.assertEqual(f.read(), "Kept 001", "Files in the journal should not be copied again.");
+		with open(os.path.join(version_path, self.file003relpath)) as f:
+			self.assertEqual(f.read(), "File 003", "Partly copied files should be copied again.");
+		self.assertEqual(len(backup.Backup.get_all_full_backups(os.path.join(self.test_bup_dir, "source_one"))), 1);
+
+	@unittest.skipUnless(hasattr(os, "symlink") and os.name == "posix", "needs symbolic links")
+	def test_statError(self):
+		loop = os.path.join(self.src1, "loop");
+		os.symlink(loop, loop);
+		self.full.add_source(self.src1);
+		self.full.set_destination(self.test_bup_dir);
+		summary = self.full.backup_source(0);
+		self.assertEqual(summary["errors"], ["Cannot Stat: %s" % loop]);
+		self.assertEqual(summary["files"], 5);
+		self.increment.add_source(self.src1);
+		self.increment.set_destination(self.test_bup_dir);
+		summary = self.increment.backup_source(0);
+		self.assertEqual(summary["failure"], None);
+
+	def test_interruptedChain(self):
+		self.full.add_source(self.src1);
+		self.full.set_destination(self.test_bup_dir);
+		self.full.backup_source(0);
+		self.increment.add_source(self.src1);
+		self.increment.set_destination(self.test_bup_dir);
+		self.make_sample_file(self.file001, "File 001 changed");
+		self.set_file_mtime(self.file001, 2015, 8, 1, 0, 0, 0);
+		# Interrupted while copying file001, before anything was journaled.
+		with mock.patch.object(backup.Journal, "add"), mock.patch.object(backup.Increment, "write_manifest"):
+			self.increment.backup_source(0);
+		interrupted = self.increment.backup_path;
+		self.assertTrue(backup.Backup.is_interrupted(interrupted),
+			"The journal should be there before the first copy.");
+		self.make_sample_file(os.path.join(interrupted, self.file001relpath), "File");
+
+		# Without --resume the half copied file is not trusted.
+		self.increment.backup_source(0);
+		self.assertEqual([c[0] for c in self.increment.copy.copylist], [self.file001]);
+		restore = backup.Restore(self.test_bup_dir, "source_one");
+		target = os.path.join(self.test_bup_dir, "Restored");
+		restore.restore(restore.find_chain(), target);
+		with open(os.path.join(target, self.file001relpath)) as f:
+			self.assertEqual(f.read(), "File 001 changed");
+
+	def test_changeLog(self):
+		log = backup.ChangeLog(os.path.join(self.test_bup_dir, "source_one", backup.CHANGE_LOG_NAME), self.src1);
+		log.start();
+		time.sleep(0.01);
+		self.full.add_source(self.src1);
+		self.full.set_destination(self.test_bup_dir);
+		self.full.backup_source(0);
+		self.increment.add_source(self.src1);
+		self.increment.set_destination(self.test_bup_dir);
+
+		# Only the directories in the log are walked.
+		self.set_file_mtime(self.file001, 2015, 8, 1, 0, 0, 0);
+		self.set_file_mtime(self.file004, 2015, 8, 1, 0, 0, 0);
+		log.changed(os.path.dirname(self.file004relpath));
+		log.flush();
+		# The log started moments before the full, well within the slack allowed.
+		with mock.patch.object(backup, "CHANGE_LOG_SLACK", 0.0):
+			summary = self.increment.backup_source(0);
+			self.assertEqual(summary["stats"]["counts"]["changed_directories"], 1);
+			self.assertEqual([c[0] for c in self.increment.copy.copylist], [self.file004]);
+
+			# The whole source is walked once changes were missed.
+			log.overflow();
+			self.increment.backup_source(0);
+			self.assertEqual([c[0] for c in self.increment.copy.copylist], [self.file001]);
+
+		# Only one watcher logs a source, and a log nobody holds is not trusted.
+		log.start();
+		with self.assertRaises(OSError):
+			backup.ChangeLog(log.filepath, self.src1).start();
+		log.file.close();
+		self.assertIsNone(backup.ChangeLog.changes(log.filepath, self.src1, 0.0));
+
+	@unittest.skipUnless(sys.platform.startswith("linux"), "inotify is only on Linux")
+	def test_watcher(self):
+		watcher = backup.Watcher();
+		backup_name_path = os.path.join(self.test_bup_dir, "source_one");
+		watcher.add_source(self.src1, backup_name_path);
+		time.sleep(0.01);
+		since = time.time();
+		self.make_sample_file(self.file004, "File 00X");
+		new_dir = os.path.join(self.src1_sub2, "new");
+		self.make_dirs(new_dir);
+		while True:
+			watcher.handle(os.read(watcher.fd, 64 * 1024));
+			changes = backup.ChangeLog.changes(os.path.join(backup_name_path, backup.CHANGE_LOG_NAME),
+				self.src1, since);
+			if changes is None or len(changes) >= 2:
+				break;
+		os.close(watcher.fd);
+		watcher.logs[0].file.close();
+		self.assertEqual(changes, {os.path.dirname(self.file004relpath): False, os.path.join("sub2", "new"): True});
+
+class RestoreTestCase(BackupTestCase):
+	def setUp(self):
+		self.set_up_sources();
+		self.set_up_backup_dest();
+		self.target = os.path.join(self.test_bup_dir, "Restored");
+		self.full = backup.Full();
+		self.full.add_source(self.src1);
+		self.full.set_destination(self.test_bup_dir);
+		self.increment = backup.Increment();
+		self.increment.add_source(self.src1);
+		self.increment.set_destination(self.test_bup_dir);
+		self.full.backup_source(0);
+		self.make_sample_file(self.file001, "File 001 changed");
+		self.set_file_mtime(self.file001, 2015, 8, 1, 0, 0, 0);
+		self.increment.backup_source(0);
+		self.make_sample_file(self.file003, "File 003 changed");
+		self.increment.backup_source(0);
+		self.restore = backup.Restore(self.test_bup_dir, "source_one", 2);
+
+	def tearDown(self):
+		self.destroy_sources();
+		self.destroy_backup_dest();
+
+	def read(self, relpath):
+		with open(os.path.join(self.target, relpath)) as f:
+			return f.read();
+
+	def test_findChain(self):
+		chain = self.restore.find_chain();
+		self.assertEqual([no for no, path in chain], [2, 1, 0]);
+		self.assertEqual(chain[0][1], self.increment.backup_path);
+		self.assertEqual([no for no, path in self.restore.find_chain("1-1")], [1, 0]);
+		self.assertEqual([no for no, path in self.restore.find_chain("1")], [0]);
+		self.assertEqual(len(self.restore.find_chain(at="9999")), 3);
+		self.assertRaises(backup.NoVersionError, self.restore.find_chain, "2");
+		self.assertRaises(backup.NoVersionError, self.restore.find_chain, None, "2000-01-01");
+
+	def test_restoreLatest(self):
+		self.restore.restore(self.restore.find_chain(), self.target);
+		self.assertEqual(self.restore.count, 5);
+		self.assertEqual(self.restore.errors, []);
+		self.assertEqual(self.read(self.file001relpath), "File 001 changed");
+		self.assertEqual(self.read(self.file003relpath), "File 003 changed");
+		self.assertEqual(self.read(self.file005relpath), "File 005");
+		self.assertEqual(os.path.getmtime(os.path.join(self.target, self.file005relpath)),
+			os.path.getmtime(self.file005));
+
+	def test_restoreVersion(self):
+		self.restore.restore(self.restore.find_chain("1-1"), self.target);
+		self.assertEqual(self.read(self.file001relpath), "File 001 changed");
+		self.assertEqual(self.read(self.file003relpath), "File 003");
+
+	def test_verify(self):
+		verify = backup.Verify(self.test_bup_dir, "source_one", 2, self.src1);
+		report = verify.verify(verify.find_chain());
+		self.assertEqual(report["checked"], 5);
+		self.assertEqual((report["missing"], report["corrupt"], report["mismatched"]), ([], [], []));
+
+		os.remove(os.path.join(self.full.backup_path, self.file004relpath));
+		self.make_sample_file(os.path.join(self.increment.backup_path, self.file003relpath), "File 003 broken");
+		mtime = os.path.getmtime(self.file005);
+		self.make_sample_file(self.file005, "File 00X");
+		os.utime(self.file005, (mtime, mtime));
+		# Resumed after checking file001.
+		state = os.path.join(self.test_bup_dir, "source_one",
+			backup.VERIFY_STATE_PREFIX + os.path.basename(self.increment.backup_path));
+		with open(state, "w") as f:
+			f.write(json.dumps([self.file001relpath, None]) + "\n");
+		verify = backup.Verify(self.test_bup_dir, "source_one", 2, self.src1, 1024 * 1024);
+		report = verify.verify(verify.find_chain(), True);
+		self.assertEqual(report["checked"], 5, "file001 should not be checked again.");
+		self.assertEqual(report["missing"], [self.file004relpath]);
+		self.assertEqual(report["corrupt"], [self.file003relpath]);
+		self.assertEqual(report["mismatched"], [self.file005relpath]);
+		self.assertFalse(os.path.exists(state));
+
+	def test_differential(self):
+		differential = backup.Differential();
+		differential.add_source(self.src1);
+		differential.set_destination(self.test_bup_dir);
+		self.make_sample_file(self.file004, "File 004 changed");
+		self.set_file_mtime(self.file004, 2015, 8, 1, 0, 0, 0);
+		differential.backup_source(0);
+		self.assertEqual(os.path.basename(differential.backup_path)[17:], "Differential-1-3");
+		self.assertEqual(sorted(c[0] for c in differential.copy.copylist), [self.file001, self.file003, self.file004],
+			"Everything changed since the full backup should be copied.");
+		self.assertEqual(self.restore.find_chain(), [(3, differential.backup_path), (0, self.full.backup_path)]);
+		self.assertEqual([no for no, path in self.restore.find_chain("1-2")], [2, 1, 0]);
+
+		# Increments after it only need the differential and the full backup.
+		self.make_sample_file(self.file005, "File 005 changed");
+		self.increment.backup_source(0);
+		self.assertEqual(os.path.basename(self.increment.backup_path)[17:], "Increment-1-4");
+		self.assertEqual([c[0] for c in self.increment.copy.copylist], [self.file005]);
+		self.assertEqual([no for no, path in self.restore.find_chain()], [4, 3, 0]);
+		self.restore.restore(self.restore.find_chain(), self.target);
+		self.assertEqual(self.read(self.file004relpath), "File 004 changed");
+		self.assertEqual(self.read(self.file005relpath), "File 005 changed");
+
+	def test_synthesizeFull(self):
+		synthesize = backup.Synthesize(self.test_bup_dir, "source_one", 2);
+		report = synthesize.synthesize(synthesize.find_chain());
+		self.assertEqual(report["files"], 5);
+		self.assertEqual(report["linked"], 5);
+		self.assertEqual(report["started"], backup.Increment.started(self.increment.backup_path));
+		full = backup.Backup.get_last_full_backup(os.path.join(self.test_bup_dir, "source_one"));
+		self.assertEqual((full[0], os.path.basename(full[1])), (2, report["version"]));
+		self.assertTrue(os.path.samefile(os.path.join(full[1], self.file003relpath),
+			os.path.join(self.increment.backup_path, self.file003relpath)));
+
+		# The new full backup restores on its own.
+		self.assertEqual(self.restore.find_chain(), [(0, full[1])]);
+		self.restore.restore(self.restore.find_chain(), self.target);
+		self.assertEqual(self.read(self.file001relpath), "File 001 changed");
+		self.assertEqual(self.read(self.file003relpath), "File 003 changed");
+		self.assertEqual(self.read(self.file004relpath), "File 004");
+
+		# Increments follow on from it.
+		self.make_sample_file(self.file004, "File 004 changed");
+		self.set_file_mtime(self.file004, 2015, 8, 1, 0, 0, 0);
+		self.increment.backup_source(0);
+		self.assertEqual(os.path.basename(self.increment.backup_path)[17:], "Increment-2-1");
+		self.assertEqual([c[0] for c in self.increment.copy.copylist], [self.file004]);
+
 if __name__ == "__main__":
 	unittest.main();